@@ -0,0 +1,240 @@
+"""
+Operation Dashboard - ASGI 入口
+
+    gunicorn                                              # 读取 gunicorn.conf.py，安装了 uvicorn 时即为本模式
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+    uvicorn asgi:app --port 5000
+
+所有路由仍由 server.py 的 Flask 应用处理：普通请求（含数据库访问）放到有界线程池里执行，
+事件循环本身从不阻塞在 SQLite 锁上；/api/stream 的实时推送直接在事件循环里等待变更，
+长连接不占用线程，单个进程可以同时挂住数千个推送客户端。
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+
+# 执行 Flask 请求的线程数；决定同时访问数据库的请求数上限
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+# 请求体超过该字节数时转存到临时文件
+ASGI_BODY_SPOOL = 1024 * 1024
+# 流式响应（导出、下载）每次从线程池取出的最大字节数
+ASGI_CHUNK_BYTES = 64 * 1024
+
+
+class AsyncSubscriber:
+    """ChangeBus 的异步订阅者：轮询线程投递事件，事件循环里 await 读取"""
+
+    def __init__(self, loop, maxsize=100):
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+
+    def put_nowait(self, event):
+        """由 ChangeBus 的轮询线程调用"""
+        self._loop.call_soon_threadsafe(self._deliver, event)
+
+    def _deliver(self, event):
+        if self._queue.full():
+            # 客户端消费太慢：丢弃积压，通知它整体刷新一次
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            event = {"seq": event['seq'], "kind": "resync", "payload": {}}
+        self._queue.put_nowait(event)
+
+    def get_nowait(self):
+        return self._queue.get_nowait()
+
+    def empty(self):
+        return self._queue.empty()
+
+    async def get(self):
+        return await self._queue.get()
+
+
+class FlaskAsgiApp:
+    """把 Flask（WSGI）应用包装成 ASGI 应用"""
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        # gunicorn fork 之后各 worker 各建自己的线程池
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=ASGI_BODY_SPOOL)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        return body
+
+    @staticmethod
+    def build_environ(scope, body):
+        """按 PEP 3333 由 ASGI scope 构造 WSGI environ"""
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+            if name in environ:
+                # 重复的请求头按 RFC 9110 用逗号合并，Cookie 按 RFC 6265 用分号合并
+                value = f"{environ[name]}{'; ' if name == 'HTTP_COOKIE' else ','}{value}"
+            environ[name] = value
+        if 'CONTENT_LENGTH' not in environ:
+            environ['CONTENT_LENGTH'] = str(body.seek(0, os.SEEK_END))
+            body.seek(0)
+        return environ
+
+    def call_wsgi(self, environ):
+        """在线程池里执行 Flask，返回 (状态码, 响应头, 响应体, 响应体迭代器, 第一批数据, 是否已取完)"""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        result = self.wsgi_app(environ, start_response)
+        iterator = iter(result)
+        chunks, done = self.pull(iterator)
+        return response['status'], response['headers'], result, iterator, chunks, done
+
+    @staticmethod
+    def pull(iterator):
+        """取出最多 ASGI_CHUNK_BYTES 字节的响应数据；小响应一次取完，只占用一次线程"""
+        chunks, size = [], 0
+        for chunk in iterator:
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+            if size >= ASGI_CHUNK_BYTES:
+                return chunks, False
+        return chunks, True
+
+    async def handle_http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        environ = self.build_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        subscriber = None
+        if scope['method'] == 'GET' and scope['path'].endswith('/api/stream'):
+            subscriber = AsyncSubscriber(loop)
+            environ['dashboard.async_subscriber'] = subscriber
+
+        try:
+            status, headers, result, iterator, chunks, done = await loop.run_in_executor(
+                self.executor, self.call_wsgi, environ)
+        finally:
+            body.close()
+        try:
+            stream = environ.get('dashboard.async_stream')
+            if stream is not None:
+                await self.stream_changes(stream, subscriber, status, headers, receive, send)
+                return
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            while True:
+                await send({'type': 'http.response.body', 'body': b''.join(chunks), 'more_body': not done})
+                if done:
+                    break
+                chunks, done = await loop.run_in_executor(self.executor, self.pull, iterator)
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.executor, result.close)
+
+    @staticmethod
+    async def stream_changes(stream, subscriber, status, headers, receive, send):
+        """在事件循环里推送变更，直到客户端断开或达到 SSE_MAX_DURATION"""
+        change_bus, backlog = stream
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + server.SSE_MAX_DURATION
+
+        async def emit(text):
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            # 推送响应的长度不确定，去掉空响应自带的 Content-Length
+            headers = [(name, value) for name, value in headers if name != b'content-length']
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            last_seq = backlog[-1]['seq'] if backlog else 0
+            await emit('retry: 3000\n\n')
+            for event in backlog:
+                await emit(server.format_sse(event))
+            # 定期断开让浏览器带着 Last-Event-ID 重连
+            while loop.time() < deadline:
+                getter = asyncio.ensure_future(subscriber.get())
+                done, _ = await asyncio.wait(
+                    {getter, disconnect}, timeout=min(server.SSE_HEARTBEAT, max(0, deadline - loop.time())),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnect in done:
+                    getter.cancel()
+                    return
+                if getter not in done:
+                    getter.cancel()
+                    await emit(': heartbeat\n\n')
+                    continue
+                event = getter.result()
+                if event['kind'] != 'resync' and event['seq'] <= last_seq:
+                    continue
+                last_seq = max(last_seq, event['seq'])
+                await emit(server.format_sse(event))
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnect.cancel()
+            change_bus.unsubscribe(subscriber)
+
+
+app = FlaskAsgiApp(server.app)
@@ -0,0 +1,106 @@
+"""
+ETag 检查 - 数据改写后，改写前拿到的 ETag 不能再被答成 304；出现过期的 304 时退出码为 1
+
+    python bench/check_etags.py            # 只输出过期的接口，可放进 CI
+    python bench/check_etags.py --verbose  # 输出每个场景下每个接口的结果
+
+在临时目录的空库上依次执行各个写入场景（包括打开今日页时因模板变化重算今日统计这类
+不经过写接口的改写），对每个带 ETag 的只读接口比较改写前后的响应：内容变了而旧 ETag
+仍返回 304，说明这条写入路径没有追加 change_log 也没有递增模板版本。
+"""
+
+import sys
+import argparse
+import tempfile
+
+import seed as bench_seed
+
+
+def cached_paths(date_str):
+    """带 @etag_cached 的只读接口（/api/today 本身会改写数据，单独作为场景动作）"""
+    return [
+        '/api/week',
+        '/api/lifetime',
+        '/api/achievements',
+        '/api/history/heatmap',
+        f'/api/history/{date_str}',
+        f'/api/history/range/{date_str}/{date_str}',
+    ]
+
+
+def _complete_main_tasks(server, client):
+    for task in client.get('/api/today').get_json()['mainTasks']:
+        client.post(f"/api/task/{task['id']}", json={'completed': True})
+
+
+def _add_main_template(server, client):
+    client.post('/api/admin/task-templates',
+                json={'task_name': 'ETag 检查主线', 'task_category': 'main', 'weekdays': 'all'})
+
+
+def _corrupt_daily_stats(server, client):
+    # 模拟增量计数漂移：直接改库，不记录变更
+    conn = server.get_db_connection()
+    try:
+        with server.db_transaction(conn, immediate=True):
+            conn.execute('UPDATE daily_stats SET main_completed = main_completed + 1')
+    finally:
+        server.release_db_connection(conn)
+
+
+# (场景名, 准备动作, 改写动作)：准备动作之后记下各接口的 ETag，改写动作之后检查
+SCENARIOS = [
+    ('打卡', None, _complete_main_tasks),
+    ('新增主线模板后今日页重算统计', _add_main_template, lambda server, client: client.get('/api/today')),
+    ('修复统计漂移', _corrupt_daily_stats,
+     lambda server, client: client.post('/api/admin/reconcile-stats', json={})),
+]
+
+
+def check_etags(server, verbose=False):
+    """依次执行各场景，返回 (报告行, 过期的 304 个数)"""
+    client = server.app.test_client()
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+    date_str = server.now().strftime('%Y-%m-%d')
+    client.get('/api/today')
+
+    report, failures = [], 0
+    for name, prepare, mutate in SCENARIOS:
+        if prepare is not None:
+            prepare(server, client)
+        before = {}
+        for path in cached_paths(date_str):
+            response = client.get(path)
+            before[path] = (response.headers.get('ETag'), response.get_json())
+        mutate(server, client)
+
+        for path, (etag, body) in before.items():
+            fresh = client.get(path).get_json()
+            status = client.get(path, headers={'If-None-Match': etag}).status_code
+            stale = status == 304 and fresh != body
+            failures += stale
+            if stale or verbose:
+                result = 'FAIL' if stale else 'ok'
+                report.append(f"{result:<5} {name}: {path} -> {status}{'（内容已变化）' if fresh != body else ''}")
+    return report, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='检查数据改写后旧 ETag 是否失效')
+    parser.add_argument('--verbose', action='store_true', help='输出每个场景下每个接口的结果')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='check-etags-') as data_dir:
+        # import server 时会迁移 DB_PATH，指向临时目录
+        bench_seed.configure_env(data_dir)
+        server = bench_seed.import_server()
+        report, failures = check_etags(server, args.verbose)
+    for line in report:
+        print(line)
+    print(f"过期的 304 共 {failures} 个")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
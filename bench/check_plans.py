@@ -0,0 +1,150 @@
+"""
+查询计划检查 - 对 server.py 中每条 SQL 执行 EXPLAIN QUERY PLAN，热点表出现全表扫描时退出码为 1
+
+    python bench/check_plans.py            # 只输出退化的查询，可放进 CI
+    python bench/check_plans.py --verbose  # 输出每条查询的执行计划
+
+SQL 用 ast 从源码中静态提取，在临时目录里按当前迁移建出的空库上执行，不接触 data/ 下的数据库。
+"""
+
+import os
+import re
+import ast
+import sys
+import sqlite3
+import argparse
+import tempfile
+
+import seed as bench_seed
+
+# 数据量随使用天数增长的表：热点查询不允许全表/全索引扫描
+PLAN_HOT_TABLES = {'tasks', 'daily_stats', 'change_log', 'checkin_runs', 'template_weekdays'}
+# 本身就是全量遍历的函数（重算、导出、迁移、整表缓存加载）
+PLAN_SCAN_ALLOWED = {
+    '_migrate_template_weekdays', '_migrate_checkin_runs', 'TemplateCache._load', 'reconcile_daily_stats',
+    'rebuild_checkin_runs', 'compute_lifetime_stats', 'iter_export_batches', 'export_data',
+    'validate_database_file', 'collect_database_gauges',
+}
+# f-string 中的动态片段按源码替换为一个有代表性的取值
+PLAN_FSTRING_SAMPLES = {
+    'cases': 'WHEN ? THEN ?',
+    'placeholders': '?',
+    'upper_op': '<',
+    'subject_sums': 'SUM(day_type IN (?))',
+    "', '.join(sets)": 'total_study_days = ?',
+    "', '.join(columns)": 'max_streak',
+    'ACHIEVEMENT_SCOPES[scope]': 'streak_record',
+    'assignments': 'total_tasks_completed = ?',
+}
+PLAN_CHECKED_VERBS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+def _sql_from_node(node, samples):
+    """把 execute() 的第一个参数还原为 SQL；无法静态确定时返回 None"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        parts = []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                parts.append(value.value)
+                continue
+            sample = samples.get(ast.unparse(value.value))
+            if sample is None:
+                return None
+            parts.append(sample)
+        return ''.join(parts)
+    return None
+
+
+def extract_sql_statements(source, samples):
+    """用 ast 找出源码中所有 execute/executemany 调用的 SQL，返回 (所在函数, 行号, SQL 或 None)"""
+    statements = []
+
+    def visit(node, scope, class_name):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                visit(child, scope, child.name)
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                # 方法记为 类名.方法名，嵌套函数归属到最外层函数
+                name = scope or (f"{class_name}.{child.name}" if class_name else child.name)
+                visit(child, name, None)
+            else:
+                if (isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute)
+                        and child.func.attr in ('execute', 'executemany') and child.args):
+                    statements.append((scope or '<module>', child.lineno, _sql_from_node(child.args[0], samples)))
+                visit(child, scope, class_name)
+
+    visit(ast.parse(source), None, None)
+    return statements
+
+
+def _count_parameters(sql):
+    """统计 ? 占位符个数（忽略字符串字面量里的问号）"""
+    return re.sub(r"'[^']*'", '', sql).count('?')
+
+
+def check_query_plans(server, verbose=False):
+    """对 server.py 中每条 SQL 执行 EXPLAIN QUERY PLAN，返回 (报告行, 退化的查询数)"""
+    # 累计统计列名取自 server.py 本身
+    samples = dict(PLAN_FSTRING_SAMPLES)
+    samples["', '.join(LIFETIME_COLUMNS)"] = ', '.join(server.LIFETIME_COLUMNS)
+    with open(server.__file__, encoding='utf-8') as f:
+        statements = extract_sql_statements(f.read(), samples)
+
+    temp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(temp_dir, 'plan.db')
+    server.migrate_database(db_path)
+    conn = sqlite3.connect(db_path)
+    report, failures = [], 0
+    try:
+        for scope, lineno, sql in statements:
+            if sql is None:
+                if verbose:
+                    report.append(f"SKIP  {scope}:{lineno} 动态 SQL")
+                continue
+            statement = ' '.join(sql.split())
+            if not statement.upper().startswith(PLAN_CHECKED_VERBS):
+                continue
+
+            plan = conn.execute(f'EXPLAIN QUERY PLAN {statement}',
+                                [None] * _count_parameters(statement)).fetchall()
+            details = [row[3] for row in plan]
+            # 执行计划里显示的是别名，先还原成表名
+            aliases = {alias: table for table, alias in
+                       re.findall(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', statement, re.I)}
+            scans = [d for d in details
+                     if d.startswith('SCAN ') and aliases.get(d.split()[1], d.split()[1]) in PLAN_HOT_TABLES]
+            regressed = bool(scans) and scope not in PLAN_SCAN_ALLOWED
+            failures += regressed
+
+            if regressed or verbose:
+                status = 'FAIL' if regressed else 'ok'
+                report.append(f"{status:<5} {scope}:{lineno} {statement[:90]}")
+                report.extend(f"        {d}" for d in details)
+    finally:
+        conn.close()
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+    return report, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='检查 server.py 中所有 SQL 的查询计划')
+    parser.add_argument('--verbose', action='store_true', help='输出每条查询的执行计划')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='check-plans-') as data_dir:
+        # import server 时会迁移 DB_PATH，指向临时目录
+        bench_seed.configure_env(data_dir)
+        server = bench_seed.import_server()
+        report, failures = check_query_plans(server, args.verbose)
+    for line in report:
+        print(line)
+    print(f"全表扫描退化 {failures} 条")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
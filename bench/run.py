@@ -0,0 +1,410 @@
+"""
+API 压测 - 测量 /api/today、/api/week、/api/task/<id> 在不同并发下的延迟分位数、吞吐和每请求 SQL 条数
+
+    python bench/run.py                                   # 进程内，经 Flask test client
+    python bench/run.py --mode http --workers 2           # 启动真实 gunicorn，用本地 asyncio 客户端压测
+    python bench/run.py --save bench/baseline.json        # 保存基线
+    python bench/run.py --compare bench/baseline.json     # 与基线对比，退化时退出码为 1
+
+每次运行先用 seed.py 在临时目录生成合成数据库；SQL 条数通过 sqlite3 的 trace 回调统计，
+只在进程内模式可得（http 模式下为 null）。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import importlib.util
+
+import seed as bench_seed
+
+SCENARIOS = ('today', 'week', 'toggle')
+
+
+# ==================== 统计 ====================
+
+def percentile(sorted_values, p):
+    """最近秩百分位数"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed, queries=None):
+    """汇总一轮压测：毫秒延迟分位数、吞吐、每请求 SQL 条数"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "rps": round(count / elapsed, 1) if elapsed else 0,
+        "p50": round(percentile(latencies, 50) * 1000, 2) if count else None,
+        "p95": round(percentile(latencies, 95) * 1000, 2) if count else None,
+        "p99": round(percentile(latencies, 99) * 1000, 2) if count else None,
+        "queriesPerRequest": round(queries / count, 2) if queries is not None and count else None
+    }
+
+
+class QueryCounter:
+    """给连接池新建的连接挂上 trace 回调，统计本进程执行的 SQL 条数
+
+    不按线程统计：开启 DB_WRITE_QUEUE 时写操作在写线程里执行，不在发起请求的线程上。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def install(self, server):
+        connect = server.ConnectionPool._connect
+        counter = self
+
+        def traced_connect(pool):
+            conn = connect(pool)
+            conn.set_trace_callback(counter._count)
+            return conn
+
+        server.ConnectionPool._connect = traced_connect
+
+    def _count(self, statement):
+        with self._lock:
+            self.total += 1
+
+    def take(self):
+        """取出并清零计数"""
+        with self._lock:
+            count, self.total = self.total, 0
+        return count
+
+
+# ==================== 请求构造 ====================
+
+def make_request(scenario, user, task_ids, rng, multi_user):
+    """返回 (method, path, body, headers)"""
+    prefix = f'/u/{user}' if multi_user else ''
+    if scenario == 'today':
+        return 'GET', f'{prefix}/api/today', None, {}
+    if scenario == 'week':
+        return 'GET', f'{prefix}/api/week', None, {}
+    body = json.dumps({"completed": rng.random() < 0.5}).encode()
+    return 'POST', f'{prefix}/api/task/{rng.choice(task_ids[user])}', body, {'Content-Type': 'application/json'}
+
+
+# ==================== 进程内（test client） ====================
+
+def run_client(server, counter, scenario, concurrency, duration, users, task_ids):
+    """多线程各持一个 test client 压测 duration 秒"""
+    multi_user = len(users) > 1
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    # 所有线程同时开始，开始前清零 SQL 计数
+    barrier = threading.Barrier(concurrency + 1, action=counter.take)
+
+    def worker(index):
+        client = server.app.test_client()
+        rng = random.Random(index)
+        local_latencies, local_errors = [], 0
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            method, path, body, headers = make_request(scenario, users[index % len(users)], task_ids, rng, multi_user)
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=body, headers=headers)
+            local_latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - start, counter.take())
+
+
+def client_task_ids(server, users):
+    """每个用户今天的任务 id（首次请求同时物化今天的任务）"""
+    client = server.app.test_client()
+    task_ids = {}
+    for user in users:
+        today = client.get(f'/u/{user}/api/today').get_json()
+        task_ids[user] = [task['id'] for task in today['allTasks']]
+    return task_ids
+
+
+# ==================== 真实进程（gunicorn + asyncio 客户端） ====================
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(port, workers, threads, asgi=False):
+    """启动 gunicorn 并等待就绪；未安装 gunicorn（ASGI 模式还需 uvicorn）时返回 None"""
+    if importlib.util.find_spec('gunicorn') is None or (asgi and importlib.util.find_spec('uvicorn') is None):
+        return None
+    if asgi:
+        worker_args = ['-k', 'uvicorn.workers.UvicornWorker', 'asgi:app']
+    else:
+        worker_args = ['-k', 'gthread', '--threads', str(threads), 'server:app']
+    env = dict(os.environ, ASGI_THREADS=str(threads))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--chdir', bench_seed.ROOT, '-w', str(workers),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning', *worker_args],
+        env=env
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn 退出，返回码 {process.returncode}')
+        try:
+            status, _ = asyncio.run(http_request('127.0.0.1', port, 'GET', '/api/today'))
+            if status == 200:
+                return process
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn 启动超时')
+
+
+def encode_request(method, path, body, headers):
+    lines = [f'{method} {path} HTTP/1.1', 'Host: 127.0.0.1']
+    lines += [f'{key}: {value}' for key, value in headers.items()]
+    lines.append(f'Content-Length: {len(body) if body else 0}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b'')
+
+
+async def read_response(reader):
+    """读取一个 HTTP/1.1 响应，返回 (状态码, 响应体, 是否保持连接)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('连接已关闭')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            body += chunk[:-2]
+    else:
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, body, headers.get('connection', '').lower() != 'close'
+
+
+async def http_request(host, port, method, path, body=None, headers=None):
+    """单次请求（新建连接），返回 (状态码, 响应体)"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(encode_request(method, path, body, headers or {}))
+        await writer.drain()
+        status, body, _ = await read_response(reader)
+        return status, body
+    finally:
+        writer.close()
+
+
+async def http_load(port, scenario, concurrency, duration, users, task_ids):
+    """concurrency 个保持连接的协程压测 duration 秒"""
+    multi_user = len(users) > 1
+    latencies, errors = [], [0]
+    deadline = time.perf_counter() + duration
+
+    async def worker(index):
+        rng = random.Random(index)
+        reader = writer = None
+        while time.perf_counter() < deadline:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            method, path, body, headers = make_request(scenario, users[index % len(users)], task_ids, rng, multi_user)
+            start = time.perf_counter()
+            try:
+                writer.write(encode_request(method, path, body, headers))
+                await writer.drain()
+                status, _, keep_alive = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                # 服务端关闭了空闲连接：重连后重发，不计入延迟
+                writer.close()
+                writer = None
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors[0] += 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def http_task_ids(port, users):
+    task_ids = {}
+    for user in users:
+        _, body = asyncio.run(http_request('127.0.0.1', port, 'GET', f'/u/{user}/api/today'))
+        task_ids[user] = [task['id'] for task in json.loads(body)['allTasks']]
+    return task_ids
+
+
+# ==================== 基线 ====================
+
+def environment_info():
+    import sqlite3
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=bench_seed.ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count()
+    }
+
+
+def compare(results, baseline, latency_threshold):
+    """与基线逐项对比，返回退化条数：p95 变慢超过阈值，或每请求 SQL 条数增加"""
+    regressions = 0
+    print(f"\n{'场景':<24}{'p95 基线':>10}{'p95 当前':>10}{'变化':>9}{'req/s 变化':>12}{'SQL/请求':>14}")
+    for key, current in results.items():
+        old = baseline['results'].get(key)
+        if not old or not old['p95'] or not current['p95']:
+            continue
+        p95_change = current['p95'] / old['p95'] - 1
+        rps_change = current['rps'] / old['rps'] - 1 if old['rps'] else 0
+        flags = []
+        if p95_change > latency_threshold:
+            flags.append('延迟退化')
+        queries = ''
+        if old['queriesPerRequest'] is not None and current['queriesPerRequest'] is not None:
+            queries = f"{old['queriesPerRequest']} -> {current['queriesPerRequest']}"
+            if current['queriesPerRequest'] > old['queriesPerRequest'] * 1.1 + 0.5:
+                flags.append('SQL 增加')
+        regressions += bool(flags)
+        print(f"{key:<24}{old['p95']:>10}{current['p95']:>10}{p95_change:>+9.0%}{rps_change:>+12.0%}"
+              f"{queries:>14}  {' '.join(flags)}")
+    return regressions
+
+
+# ==================== 命令行 ====================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='作战仪表盘 API 压测')
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='client',
+                        help='client: 进程内 test client；http: 真实 gunicorn 进程')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔：today,week,toggle')
+    parser.add_argument('--concurrency', default='1,8', help='逗号分隔的并发数')
+    parser.add_argument('--duration', type=float, default=3, help='每轮持续秒数')
+    parser.add_argument('--years', type=float, default=1, help='合成历史数据年数')
+    parser.add_argument('--templates', type=int, default=10, help='额外支线任务模板数')
+    parser.add_argument('--users', type=int, default=1, help='用户数，请求按并发序号轮流分配给各用户')
+    parser.add_argument('--workers', type=int, default=2, help='http 模式的 gunicorn worker 数')
+    parser.add_argument('--threads', type=int, default=4, help='http 模式每个 worker 的线程数（ASGI 模式为 ASGI_THREADS）')
+    parser.add_argument('--asgi', action='store_true', help='http 模式改用 asgi:app + UvicornWorker')
+    parser.add_argument('--data-dir', help='数据目录（默认临时目录）')
+    parser.add_argument('--save', help='把结果写入基线文件')
+    parser.add_argument('--compare', help='与基线文件对比')
+    parser.add_argument('--threshold', type=float, default=0.5, help='p95 变慢超过该比例视为退化')
+    args = parser.parse_args(argv)
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+    config = {key: getattr(args, key) for key in ('years', 'templates', 'users', 'duration', 'workers', 'threads', 'asgi')}
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='dashboard-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), 'seed.py'), '--data-dir', data_dir,
+                    '--years', str(args.years), '--templates', str(args.templates), '--users', str(args.users)],
+                   check=True)
+    bench_seed.configure_env(data_dir, args.users)
+    users = bench_seed.user_names(args.users)
+
+    results = {}
+    print(f"\n{'场景':<24}{'请求数':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'错误':>6}{'SQL/请求':>10}")
+
+    def report(key, result):
+        results[key] = result
+        queries = '-' if result['queriesPerRequest'] is None else result['queriesPerRequest']
+        print(f"{key:<24}{result['requests']:>8}{result['rps']:>9}{result['p50']:>9}{result['p95']:>9}"
+              f"{result['p99']:>9}{result['errors']:>6}{queries:>10}")
+
+    if args.mode in ('client', 'both'):
+        server = bench_seed.import_server()
+        counter = QueryCounter()
+        counter.install(server)
+        task_ids = client_task_ids(server, users)
+        for scenario in scenarios:
+            for level in levels:
+                report(f'client/{scenario}/c{level}',
+                       run_client(server, counter, scenario, level, args.duration, users, task_ids))
+
+    if args.mode in ('http', 'both'):
+        port = free_port()
+        process = start_gunicorn(port, args.workers, args.threads, args.asgi)
+        mode = 'asgi' if args.asgi else 'http'
+        if process is None:
+            print('未安装 gunicorn 或 uvicorn，跳过 http 模式')
+        else:
+            try:
+                task_ids = http_task_ids(port, users)
+                for scenario in scenarios:
+                    for level in levels:
+                        report(f'{mode}/{scenario}/c{level}',
+                               asyncio.run(http_load(port, scenario, level, args.duration, users, task_ids)))
+            finally:
+                process.terminate()
+                process.wait()
+
+    status = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print(f"注意：基线参数 {baseline.get('config')} 与本次 {config} 不同")
+        regressions = compare(results, baseline, args.threshold)
+        print(f"退化 {regressions} 项")
+        status = 1 if regressions else 0
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({"config": config, "environment": environment_info(), "results": results},
+                      f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"已保存基线 {args.save}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
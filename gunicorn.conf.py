@@ -0,0 +1,34 @@
+"""
+gunicorn 配置 - gunicorn 启动时自动读取当前目录下的本文件，命令行参数优先
+
+    gunicorn                 # 安装了 uvicorn 时为 ASGI 模式（asgi:app），否则为 gthread 线程模式（server:app）
+    ASGI=0 gunicorn          # 强制线程模式
+
+ASGI 模式下请求在每个 worker 的 ASGI_THREADS 个线程里执行，实时推送不占线程；
+线程模式下每个推送连接占用一个线程，受 SSE_MAX_CLIENTS 限制。
+"""
+
+import os
+import importlib.util
+
+ASGI = os.environ.get('ASGI', '1') == '1' and importlib.util.find_spec('uvicorn') is not None
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# SQLite 同一时刻只有一个写者，多开 worker 主要提升读并发；默认 2 个，可用 WEB_CONCURRENCY 调整
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+if ASGI:
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'server:app'
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# 推送连接每 SSE_MAX_DURATION 秒重连一次，worker 心跳超时与请求时长无关
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# 定期轮换 worker，限制内存缓慢增长；监控计数由 /metrics 的归档文件保留
+max_requests = 5000
+max_requests_jitter = 500
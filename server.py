@@ -7,15 +7,34 @@ Operation Dashboard - 作战仪表盘 v3.1
 """
 
 import os
+import io
+import re
+import sys
+import csv
 import json
+import zlib
+import tempfile
+import argparse
 import sqlite3
 import hashlib
+import time
+import queue
+import atexit
+import bisect
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from functools import wraps
-from flask import Flask, jsonify, request, send_from_directory, redirect, session, send_file
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，跨进程文件锁退化为空操作
+    fcntl = None
+from flask import Flask, Response, jsonify, request, send_from_directory, redirect, session, send_file, g, has_app_context, has_request_context, make_response
 from flask_cors import CORS
-import shutil 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'operation-dashboard-secret-key-2024')
@@ -25,6 +44,66 @@ CORS(app)
 DB_PATH = os.environ.get('DB_PATH', os.path.join(os.path.dirname(__file__), 'data', 'operations.db'))
 STATIC_PATH = os.path.dirname(__file__)
 ADMIN_PASSWORD_HASH = os.environ.get('ADMIN_PASSWORD_HASH', hashlib.sha256('admin123'.encode()).hexdigest())
+# 每个 worker 进程内保留的空闲连接上限
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# 只读查询（历史/周统计）使用的数据库，可指向只读副本；默认与主库相同
+DB_READ_PATH = os.environ.get('DB_READ_PATH', DB_PATH)
+# 多用户：每个用户一个独立的数据库文件 TENANTS_DIR/<用户名>.db，写锁互不影响；
+# 未设置时只有 DB_PATH 这一个默认用户
+TENANTS_DIR = os.environ.get('TENANTS_DIR', '')
+# 非默认用户每个连接池保留的空闲连接数、每个 worker 同时保持打开的用户数
+TENANT_POOL_SIZE = int(os.environ.get('TENANT_POOL_SIZE', 2))
+TENANT_MAX_OPEN = int(os.environ.get('TENANT_MAX_OPEN', 64))
+DEFAULT_TENANT = 'default'
+# 是否按请求头 X-Dashboard-User 选择用户：只应在前面有认证代理、且代理会覆盖客户端自带的同名头时开启
+TRUST_USER_HEADER = os.environ.get('TRUST_USER_HEADER', '0') == '1'
+# 写入队列：请求线程的写操作交给每个用户一个的写线程，成批放进一个事务提交；设为 0 时各请求线程直接写库
+DB_WRITE_QUEUE = os.environ.get('DB_WRITE_QUEUE', '1') == '1'
+# 每批最多合并的写操作数、请求等待写线程的最长时间（秒）、写线程空闲多少秒后退出
+WRITE_BATCH_MAX = int(os.environ.get('WRITE_BATCH_MAX', 64))
+WRITE_TIMEOUT = float(os.environ.get('WRITE_TIMEOUT', 30))
+WRITE_IDLE_SECONDS = 30
+# 实时推送（SSE）：变更轮询间隔（秒）、单连接最长保持时间（秒）、每个 worker 最多同时推送的客户端数
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 0.5))
+SSE_MAX_DURATION = int(os.environ.get('SSE_MAX_DURATION', 300))
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 24))
+SSE_HEARTBEAT = 15
+# ASGI 模式（asgi.py）下推送不占线程，每个 worker 允许的推送客户端数可以高得多
+ASGI_SSE_MAX_CLIENTS = int(os.environ.get('ASGI_SSE_MAX_CLIENTS', 2000))
+# change_log 只保留最近的变更，供断线重连补发
+CHANGE_LOG_KEEP = 1000
+# 流式导出每批从游标读取的行数
+EXPORT_BATCH_SIZE = 500
+# 历史区间查询允许的最大跨度（天），同时也是每页条数上限
+HISTORY_MAX_SPAN_DAYS = 366
+# 在线备份：每步复制的页数与步间休眠（秒），步与步之间释放读锁，不阻塞写入
+BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 256))
+BACKUP_STEP_SLEEP = 0.005
+# 定时快照：存放目录、间隔（小时，0 表示关闭）以及按日/周/月保留的份数
+BACKUP_DIR = os.environ.get('BACKUP_DIR', os.path.join(os.path.dirname(DB_PATH), 'backups'))
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', 24))
+BACKUP_KEEP_DAILY = int(os.environ.get('BACKUP_KEEP_DAILY', 7))
+BACKUP_KEEP_WEEKLY = int(os.environ.get('BACKUP_KEEP_WEEKLY', 4))
+BACKUP_KEEP_MONTHLY = int(os.environ.get('BACKUP_KEEP_MONTHLY', 6))
+BACKUP_CHECK_INTERVAL = 600
+# 性能追踪（默认关闭）：统计每个请求的 SQL 条数、读写行数、提交耗时和关键函数耗时，
+# 通过 Server-Timing 响应头和 /api/admin/perf 查看；直方图只保留最近 PERF_WINDOW_SECONDS 秒
+PERF_TRACE = os.environ.get('PERF_TRACE', '0') == '1'
+PERF_WINDOW_SECONDS = int(os.environ.get('PERF_WINDOW_SECONDS', 300))
+# /metrics：各 worker 计数文件的目录与写入间隔（秒）；设置 METRICS_TOKEN 后抓取需带 Authorization: Bearer <token>
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(os.path.dirname(DB_PATH), 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# 可导出的表及其查询（流式导出按此顺序输出）
+EXPORT_TABLES = {
+    "tasks": "SELECT * FROM tasks ORDER BY date",
+    "daily_stats": "SELECT * FROM daily_stats ORDER BY date",
+    "streak_record": "SELECT * FROM streak_record",
+    "lifetime_stats": "SELECT * FROM lifetime_stats",
+    "achievements": "SELECT * FROM achievements",
+    "task_templates": "SELECT * FROM task_templates",
+}
 
 # 时区配置：北京时间 UTC+8
 BEIJING_OFFSET = timedelta(hours=8)
@@ -70,6 +149,9 @@ DEFAULT_TASKS = [
     {"name": "Godot摸鱼", "category": "optional", "weekdays": "6"},
 ]
 
+# 一周七天（weekday 0=周一 ... 6=周日）
+ALL_WEEKDAYS = tuple(range(7))
+
 # 星期类型映射
 DAY_TYPES = {
     0: "数学日",
@@ -81,27 +163,54 @@ DAY_TYPES = {
     6: "机动日"
 }
 
-# 成就系统配置
+# 计入 lifetime_stats 各科目天数的日类型
+DAY_TYPE_COUNTERS = {
+    "math_days": ("数学日",),
+    "cs_days": ("CS日",),
+    "english_days": ("英语日", "英语实战"),
+}
+
+# 成就系统配置：metric 达到 threshold 即解锁，scope 指明 metric 所在的表
 ACHIEVEMENTS = {
-    "first_blood": {"id": "first_blood", "name": "首战告捷", "desc": "完成第一个任务", "icon": "🎯"},
-    "streak_3": {"id": "streak_3", "name": "三连击", "desc": "连续打卡3天", "icon": "🔥"},
-    "streak_7": {"id": "streak_7", "name": "一周战士", "desc": "连续打卡7天", "icon": "⚡"},
-    "streak_30": {"id": "streak_30", "name": "月度冠军", "desc": "连续打卡30天", "icon": "👑"},
-    "perfect_day": {"id": "perfect_day", "name": "完美一天", "desc": "主线+支线全部完成", "icon": "💎"},
-    "task_master": {"id": "task_master", "name": "任务大师", "desc": "累计完成100个任务", "icon": "🏆"},
-    "main_master": {"id": "main_master", "name": "主线达人", "desc": "累计完成50个主线任务", "icon": "🥇"},
-    "math_master": {"id": "math_master", "name": "数学达人", "desc": "完成10个数学日", "icon": "📐"},
-    "cs_master": {"id": "cs_master", "name": "CS专家", "desc": "完成10个CS日", "icon": "💻"},
-    "english_master": {"id": "english_master", "name": "英语通", "desc": "完成10个英语日", "icon": "📚"}
+    "first_blood": {"id": "first_blood", "name": "首战告捷", "desc": "完成第一个任务", "icon": "🎯",
+                    "scope": "lifetime", "metric": "total_tasks_completed", "threshold": 1},
+    "streak_3": {"id": "streak_3", "name": "三连击", "desc": "连续打卡3天", "icon": "🔥",
+                 "scope": "streak", "metric": "max_streak", "threshold": 3},
+    "streak_7": {"id": "streak_7", "name": "一周战士", "desc": "连续打卡7天", "icon": "⚡",
+                 "scope": "streak", "metric": "max_streak", "threshold": 7},
+    "streak_30": {"id": "streak_30", "name": "月度冠军", "desc": "连续打卡30天", "icon": "👑",
+                  "scope": "streak", "metric": "max_streak", "threshold": 30},
+    "perfect_day": {"id": "perfect_day", "name": "完美一天", "desc": "主线+支线全部完成", "icon": "💎",
+                    "scope": "lifetime", "metric": "total_perfect_days", "threshold": 1},
+    "task_master": {"id": "task_master", "name": "任务大师", "desc": "累计完成100个任务", "icon": "🏆",
+                    "scope": "lifetime", "metric": "total_tasks_completed", "threshold": 100},
+    "main_master": {"id": "main_master", "name": "主线达人", "desc": "累计完成50个主线任务", "icon": "🥇",
+                    "scope": "lifetime", "metric": "main_tasks_completed", "threshold": 50},
+    "math_master": {"id": "math_master", "name": "数学达人", "desc": "完成10个数学日", "icon": "📐",
+                    "scope": "lifetime", "metric": "math_days", "threshold": 10},
+    "cs_master": {"id": "cs_master", "name": "CS专家", "desc": "完成10个CS日", "icon": "💻",
+                  "scope": "lifetime", "metric": "cs_days", "threshold": 10},
+    "english_master": {"id": "english_master", "name": "英语通", "desc": "完成10个英语日", "icon": "📚",
+                       "scope": "lifetime", "metric": "english_days", "threshold": 10}
 }
 
+# 成就 scope 对应的单行统计表
+ACHIEVEMENT_SCOPES = {
+    "lifetime": "lifetime_stats",
+    "streak": "streak_record",
+}
 
-def init_database():
-    """初始化SQLite数据库 - v3.1版本"""
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+
+# ==================== 数据库迁移 ====================
+#
+# 表结构版本记录在 PRAGMA user_version 中，每个迁移函数把数据库从 N-1 升级到 N。
+# 已发布的迁移不要再修改，表结构变更一律追加新的迁移；迁移里只写固定的 SQL，不调用
+# 应用里会继续演进的辅助函数，否则旧迁移的行为会跟着悄悄改变。v1~v6 对应此前散落在
+# init_database() 里的建表语句，全部使用 IF NOT EXISTS，user_version 仍为 0 的旧库
+# 可以安全地从头执行。
+
+def _migrate_base_tables(cursor):
+    """基础表结构：模板、任务、每日统计、连续打卡、成就、累计统计"""
     # 任务模板表 - 存储所有任务定义（包括原系统任务）
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS task_templates (
@@ -204,45 +313,822 @@ def init_database():
                 INSERT INTO task_templates (task_name, task_category, weekdays, is_system)
                 VALUES (?, ?, ?, 1)
             ''', (task['name'], task['category'], task['weekdays']))
+
+
+def _migrate_template_weekdays(cursor):
+    """模板排期表：task_templates.weekdays 的规范化索引（每个适用星期一行）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_weekdays (
+            weekday INTEGER NOT NULL,
+            template_id INTEGER NOT NULL,
+            PRIMARY KEY (weekday, template_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_template_weekdays_template
+        ON template_weekdays (template_id)
+    ''')
     
-    conn.commit()
-    conn.close()
+    # 为还没有排期索引的模板从逗号字符串（'all' 或 '0,1,2'）生成
+    cursor.execute('''
+        SELECT id, weekdays FROM task_templates
+        WHERE id NOT IN (SELECT template_id FROM template_weekdays)
+    ''')
+    for template_id, weekdays in cursor.fetchall():
+        text = str(weekdays or '').strip()
+        if text == 'all':
+            days = set(range(7))
+        else:
+            days = {int(part) for part in (p.strip() for p in text.split(',')) if part.isdigit() and int(part) < 7}
+        cursor.executemany('''
+            INSERT OR IGNORE INTO template_weekdays (weekday, template_id) VALUES (?, ?)
+        ''', [(weekday, template_id) for weekday in sorted(days)])
+
+
+def _migrate_change_tracking(cursor):
+    """缓存版本号（app_meta）与变更日志（change_log）"""
+    # 元数据表 - 各类缓存的版本号，跨 worker 判断缓存是否失效
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('template_version', 0)")
+    
+    # 变更日志表 - 写入方随事务追加，SSE 推送据此向各 worker 的客户端广播
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migrate_checkin_runs(cursor):
+    """连续打卡区间表：每段连续的有效打卡日一行，从 daily_stats 生成"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS checkin_runs (
+            start_date TEXT PRIMARY KEY,
+            end_date TEXT NOT NULL,
+            days INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_checkin_runs_days ON checkin_runs(days)')
+    
+    # gaps-and-islands：日期减去序号相同的有效打卡日属于同一段
+    cursor.execute('DELETE FROM checkin_runs')
+    cursor.execute('''
+        INSERT INTO checkin_runs (start_date, end_date, days)
+        SELECT MIN(date), MAX(date), COUNT(*)
+        FROM (
+            SELECT date, julianday(date) - ROW_NUMBER() OVER (ORDER BY date) AS island
+            FROM daily_stats
+            WHERE is_valid_checkin = 1
+        )
+        GROUP BY island
+    ''')
+    # 连续打卡记录：最近一段的天数与结束日期，以及最长一段的天数
+    cursor.execute('''
+        UPDATE streak_record SET
+            current_streak = COALESCE((SELECT days FROM checkin_runs ORDER BY start_date DESC LIMIT 1), 0),
+            last_check_date = (SELECT end_date FROM checkin_runs ORDER BY start_date DESC LIMIT 1),
+            max_streak = COALESCE((SELECT MAX(days) FROM checkin_runs), 0)
+    ''')
+
+
+def _migrate_achievement_version(cursor):
+    """成就缓存版本号"""
+    cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('achievement_version', 0)")
+
+
+def _migrate_hot_query_indexes(cursor):
+    """热点查询的专用索引"""
+    # 管理后台修改/删除模板时按 template_id + 日期更新未来的任务实例
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_template_date ON tasks(template_id, date)')
+    # 每日统计按分类聚合：只读索引即可得到计数
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_date_category ON tasks(date, task_category, completed)')
+    # 已完成任务列表（按完成时间排序）与累计统计，只包含已完成的行
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tasks_completed
+        ON tasks(date, completed_at, task_name, task_category) WHERE completed = 1
+    ''')
+    # 热力图按日期区间读取完成率与打卡标记
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_stats_heatmap
+        ON daily_stats(date, main_completed_rate, is_valid_checkin)
+    ''')
+    # 打卡区间重建与科目天数统计只关心有效打卡日
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_stats_checkin
+        ON daily_stats(date, day_type, optional_completed, optional_tasks) WHERE is_valid_checkin = 1
+    ''')
+
 
+# 按顺序排列，下标 + 1 即迁移后的 user_version
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_template_weekdays,
+    _migrate_change_tracking,
+    _migrate_checkin_runs,
+    _migrate_achievement_version,
+    _migrate_hot_query_indexes,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(db_path=None):
+    """读取数据库当前的表结构版本"""
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=30.0)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def migrate_database(db_path=None):
+    """把数据库迁移到 SCHEMA_VERSION，返回 (迁移前版本, 迁移后版本)
 
-def get_db_connection():
-    """获取数据库连接 - 添加超时和隔离级别设置"""
-    conn = sqlite3.connect(DB_PATH, timeout=10.0)
-    conn.row_factory = sqlite3.Row
-    # 启用WAL模式以提高并发性能
-    conn.execute('PRAGMA journal_mode=WAL')
-    conn.execute('PRAGMA busy_timeout=5000')
+    已是最新版本时只执行一次 PRAGMA user_version；否则在文件锁内逐个执行迁移，
+    每个迁移与版本号写入处于同一事务，同时启动的多个 worker 只有一个会真正执行。
+    """
+    db_path = db_path or DB_PATH
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+    try:
+        initial = conn.execute('PRAGMA user_version').fetchone()[0]
+        if initial >= SCHEMA_VERSION:
+            return initial, initial
+        
+        with file_lock(db_path + '.migrate.lock'):
+            # 等锁期间其它进程可能已经完成迁移
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            cursor = conn.cursor()
+            for number in range(version + 1, SCHEMA_VERSION + 1):
+                cursor.execute('BEGIN IMMEDIATE')
+                try:
+                    MIGRATIONS[number - 1](cursor)
+                    cursor.execute(f'PRAGMA user_version = {number}')
+                except BaseException:
+                    cursor.execute('ROLLBACK')
+                    raise
+                cursor.execute('COMMIT')
+        return initial, SCHEMA_VERSION
+    finally:
+        conn.close()
+
+
+# ==================== 数据库连接池 ====================
+
+class PooledConnection(sqlite3.Connection):
+    """记录所属连接池的 SQLite 连接"""
+    pool = None
+
+
+class ConnectionPool:
+    """每个 worker 进程一个的有界连接池，PRAGMA 只在建立连接时执行一次"""
+
+    def __init__(self, db_path, max_size=DB_POOL_SIZE, readonly=False):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.reuses = 0
+
+    def _connect(self):
+        """新建连接 - 添加超时和隔离级别设置"""
+        # 连接会在不同请求线程间流转，但同一时刻只被一个请求持有
+        conn = sqlite3.connect(self.db_path, timeout=10.0, check_same_thread=False,
+                               factory=TracedConnection if PERF_TRACE else PooledConnection)
+        conn.pool = self
+        if PERF_TRACE:
+            conn.set_trace_callback(trace_statement)
+        conn.row_factory = sqlite3.Row
+        if self.readonly:
+            # 只读连接：任何写语句都会直接报错
+            conn.execute('PRAGMA query_only=1')
+        else:
+            # 启用WAL模式以提高并发性能
+            conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def _reset_after_fork(self):
+        # gunicorn fork 出的子进程不能复用父进程打开的连接
+        if self._pid != os.getpid():
+            self._idle = []
+            self._pid = os.getpid()
+            self.hits = self.misses = self.reuses = 0
+
+    def acquire(self):
+        """取出一个空闲连接，没有则新建"""
+        with self._lock:
+            self._reset_after_fork()
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+        return self._connect()
+
+    def release(self, conn):
+        """归还连接，未提交的事务一律回滚"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._reset_after_fork()
+            if not self.closed and len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """关闭空闲连接；之后归还的连接直接关闭"""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def note_reuse(self):
+        with self._lock:
+            self.reuses += 1
+
+    def stats(self):
+        """连接池命中统计"""
+        with self._lock:
+            self._reset_after_fork()
+            checkouts = self.hits + self.misses
+            return {
+                "pid": self._pid,
+                "idle": len(self._idle),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "requestReuses": self.reuses,
+                "hitRate": (self.hits / checkouts * 100) if checkouts > 0 else 0
+            }
+
+
+def parse_weekdays(weekdays):
+    """解析模板的 weekdays 字段（'all' 或 '0,1,2' 形式）为星期列表"""
+    if weekdays is None:
+        return []
+    if str(weekdays).strip() == 'all':
+        return list(ALL_WEEKDAYS)
+    result = set()
+    for part in str(weekdays).split(','):
+        part = part.strip()
+        if part.isdigit() and int(part) in ALL_WEEKDAYS:
+            result.add(int(part))
+    return sorted(result)
+
+
+def sync_template_weekdays(cursor, template_id, weekdays):
+    """重建单个模板的排期索引（不提交事务）"""
+    cursor.execute('DELETE FROM template_weekdays WHERE template_id = ?', (template_id,))
+    cursor.executemany('''
+        INSERT INTO template_weekdays (weekday, template_id) VALUES (?, ?)
+    ''', [(weekday, template_id) for weekday in parse_weekdays(weekdays)])
+
+
+def get_meta_version(conn, key):
+    """读取 app_meta 中的版本号"""
+    row = conn.execute('SELECT value FROM app_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_meta_version(conn, key, minimum=0):
+    """版本号加一（至少为 minimum + 1），随调用方事务一起提交"""
+    conn.execute('''
+        INSERT INTO app_meta (key, value) VALUES (?, ? + 1)
+        ON CONFLICT(key) DO UPDATE SET value = MAX(value, ?) + 1
+    ''', (key, minimum, minimum))
+
+
+def record_change(conn, kind, payload=None):
+    """在调用方事务内追加一条变更记录（随事务一起提交后才会被推送）
+
+    改变接口返回内容的写入都要调用：打卡（task）、模板增删改（templates）、导入（import）、
+    全量重算与每日统计改写（stats，今日快照和漂移修复经 save_daily_stats 记录）。
+    """
+    cursor = conn.execute('''
+        INSERT INTO change_log (kind, payload) VALUES (?, ?)
+    ''', (kind, json.dumps(payload or {}, ensure_ascii=False)))
+    conn.execute('DELETE FROM change_log WHERE seq <= ?', (cursor.lastrowid - CHANGE_LOG_KEEP,))
+
+
+def fetch_changes_since(conn, seq, limit=500):
+    """读取 seq 之后的变更记录"""
+    cursor = conn.execute('''
+        SELECT seq, kind, payload FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?
+    ''', (seq, limit))
+    return [{"seq": row['seq'], "kind": row['kind'], "payload": json.loads(row['payload'] or '{}')}
+            for row in cursor.fetchall()]
+
+
+def get_db_connection(readonly=False):
+    """获取数据库连接 - 同一请求内复用一个池化连接，请求结束时统一归还
+
+    readonly=True 时从只读连接池取连接（PRAGMA query_only，可指向 DB_READ_PATH 副本）。
+    连接池属于当前用户，见 current_tenant()。
+    """
+    tenant = current_tenant()
+    pool = tenant.read_pool if readonly else tenant.pool
+    if not has_app_context():
+        return pool.acquire()
+    key = 'db_read_conn' if readonly else 'db_conn'
+    conn = g.get(key)
+    if conn is None:
+        conn = pool.acquire()
+        setattr(g, key, conn)
+    else:
+        pool.note_reuse()
     return conn
 
 
-def get_task_templates(weekday=None):
-    """获取任务模板列表"""
+def release_db_connection(conn):
+    """释放连接；请求作用域的连接留给 teardown 归还"""
+    if has_app_context() and conn in (g.get('db_conn'), g.get('db_read_conn')):
+        return
+    conn.pool.release(conn)
+
+
+@app.teardown_appcontext
+def teardown_db_connection(exc):
+    """请求结束时把连接还回连接池"""
+    for key in ('db_conn', 'db_read_conn'):
+        conn = g.pop(key, None)
+        if conn is not None:
+            conn.pool.release(conn)
+
+
+@contextmanager
+def borrowed_connection(conn=None):
+    """沿用调用方传入的连接，没有则临时借用一个"""
+    if conn is not None:
+        yield conn
+        return
     conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
+
+
+@contextmanager
+def db_transaction(conn, immediate=False, lock_started=None):
+    """在连接上开启显式事务，正常退出时提交，异常时回滚；等锁时长与锁冲突计入 /metrics
+
+    调用方在 BEGIN 之前还要先等自己的锁（如写线程的文件锁）时，传入开始等锁的
+    time.perf_counter()，等锁时长从那一刻算起。
+    """
+    start = time.perf_counter() if lock_started is None else lock_started
+    try:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    except sqlite3.OperationalError as e:
+        worker_metrics.record_lock_error(e)
+        raise
+    if immediate:
+        worker_metrics.record_lock_wait(time.perf_counter() - start)
+    try:
+        yield conn
+    except BaseException as e:
+        conn.rollback()
+        worker_metrics.record_lock_error(e)
+        raise
+    conn.commit()
+
+
+def is_lock_error(exc):
+    """是否为 SQLite 锁冲突（database is locked / busy）"""
+    message = str(exc).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def is_readonly_error(exc):
+    """是否为只读连接（PRAGMA query_only）上执行了写语句"""
+    return 'readonly' in str(exc).lower()
+
+
+# ==================== 性能追踪 ====================
+
+# 滚动直方图的桶上界：耗时（毫秒）与每请求的条数/行数
+PERF_MS_BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+PERF_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+PERF_SLOT_SECONDS = 10
+# 当前请求的追踪记录；请求之外（命令行、后台线程）为 None
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class RequestTrace:
+    """一个请求内的 SQL 条数、读写行数、SQL 与提交耗时以及各函数耗时"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.db_ms = 0.0
+        self.commits = 0
+        self.commit_ms = 0.0
+        self.functions = {}
+
+    def add_function(self, name, ms):
+        count, total = self.functions.get(name, (0, 0.0))
+        self.functions[name] = (count + 1, total + ms)
+
+
+class RollingHistogram:
+    """最近 PERF_WINDOW_SECONDS 秒的数值分布，按 PERF_SLOT_SECONDS 分槽滚动淘汰"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self._slots = {}
+
+    def add(self, value, timestamp):
+        slot = int(timestamp // PERF_SLOT_SECONDS)
+        state = self._slots.get(slot)
+        if state is None:
+            state = self._slots[slot] = [[0] * len(self.bounds), 0.0, 0.0]
+            oldest = slot - PERF_WINDOW_SECONDS // PERF_SLOT_SECONDS
+            for stale in [s for s in self._slots if s <= oldest]:
+                del self._slots[stale]
+        counts = state[0]
+        counts[next(i for i, bound in enumerate(self.bounds) if value <= bound)] += 1
+        state[1] += value
+        state[2] = max(state[2], value)
+
+    def snapshot(self, timestamp):
+        oldest = int(timestamp // PERF_SLOT_SECONDS) - PERF_WINDOW_SECONDS // PERF_SLOT_SECONDS
+        counts = [0] * len(self.bounds)
+        total = peak = 0.0
+        for slot, (slot_counts, slot_total, slot_max) in self._slots.items():
+            if slot > oldest:
+                counts = [a + b for a, b in zip(counts, slot_counts)]
+                total += slot_total
+                peak = max(peak, slot_max)
+        count = sum(counts)
+        if not count:
+            return {"count": 0}
+
+        def percentile(p):
+            # 取所在桶的上界，不超过实际最大值
+            rank, seen = p / 100 * count, 0
+            for bound, bucket_count in zip(self.bounds, counts):
+                seen += bucket_count
+                if seen >= rank:
+                    return round(min(bound, peak), 2)
+
+        return {
+            "count": count,
+            "mean": round(total / count, 2),
+            "max": round(peak, 2),
+            "p50": percentile(50),
+            "p95": percentile(95),
+            "p99": percentile(99),
+            "buckets": [["+Inf" if bound == float('inf') else bound, n]
+                        for bound, n in zip(self.bounds, counts) if n]
+        }
+
+
+class PerfRecorder:
+    """每个 worker 一份的性能统计：各接口的延迟、SQL 条数、读写行数、提交耗时，以及各函数耗时"""
+
+    ENDPOINT_METRICS = (
+        ('latencyMs', PERF_MS_BUCKETS, lambda trace, total_ms: total_ms),
+        ('dbMs', PERF_MS_BUCKETS, lambda trace, total_ms: trace.db_ms),
+        ('commitMs', PERF_MS_BUCKETS, lambda trace, total_ms: trace.commit_ms),
+        ('queries', PERF_COUNT_BUCKETS, lambda trace, total_ms: trace.queries),
+        ('rowsRead', PERF_COUNT_BUCKETS, lambda trace, total_ms: trace.rows_read),
+        ('rowsWritten', PERF_COUNT_BUCKETS, lambda trace, total_ms: trace.rows_written),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self._functions = {}
+            self._since = time.time()
+
+    def record_request(self, endpoint, trace, total_ms):
+        timestamp = time.time()
+        with self._lock:
+            histograms = self._endpoints.get(endpoint)
+            if histograms is None:
+                histograms = self._endpoints[endpoint] = {
+                    name: RollingHistogram(bounds) for name, bounds, _ in self.ENDPOINT_METRICS
+                }
+            for name, _, value in self.ENDPOINT_METRICS:
+                histograms[name].add(value(trace, total_ms), timestamp)
+
+    def record_function(self, name, ms):
+        timestamp = time.time()
+        with self._lock:
+            histogram = self._functions.get(name)
+            if histogram is None:
+                histogram = self._functions[name] = RollingHistogram(PERF_MS_BUCKETS)
+            histogram.add(ms, timestamp)
+
+    def snapshot(self):
+        timestamp = time.time()
+        with self._lock:
+            endpoints = {
+                endpoint: {name: histogram.snapshot(timestamp) for name, histogram in histograms.items()}
+                for endpoint, histograms in self._endpoints.items()
+            }
+            functions = {name: histogram.snapshot(timestamp) for name, histogram in self._functions.items()}
+            since = self._since
+        return {
+            "enabled": PERF_TRACE,
+            "pid": os.getpid(),
+            "windowSeconds": PERF_WINDOW_SECONDS,
+            "since": datetime.fromtimestamp(since, ZoneInfo("Asia/Shanghai")).strftime('%Y-%m-%d %H:%M:%S'),
+            "endpoints": endpoints,
+            "functions": functions
+        }
+
+
+perf_recorder = PerfRecorder()
+
+
+def timed(func):
+    """记录函数耗时（含内部调用的其它函数）；PERF_TRACE 关闭时原样返回，没有额外开销"""
+    if not PERF_TRACE:
+        return func
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_function(name, ms)
+            perf_recorder.record_function(name, ms)
+    return wrapper
+
+
+def trace_statement(statement):
+    """sqlite3 trace 回调：每执行一条 SQL（含触发器内的语句）计数一次"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.queries += 1
+
+
+class TracedCursor(sqlite3.Cursor):
+    """把执行与取行耗时、读取和写入的行数累计到当前请求的追踪记录"""
+
+    def _timed(self, method, *args):
+        trace = current_trace.get()
+        if trace is None:
+            return method(*args)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            trace.db_ms += (time.perf_counter() - start) * 1000
+
+    def _count_rows(self, read=0):
+        trace = current_trace.get()
+        if trace is not None:
+            trace.rows_read += read
+            # rowcount 只对 INSERT/UPDATE/DELETE 为非负数
+            if not read and self.rowcount > 0:
+                trace.rows_written += self.rowcount
+
+    def execute(self, *args):
+        cursor = self._timed(super().execute, *args)
+        self._count_rows()
+        return cursor
+
+    def executemany(self, *args):
+        cursor = self._timed(super().executemany, *args)
+        self._count_rows()
+        return cursor
+
+    def executescript(self, *args):
+        return self._timed(super().executescript, *args)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed(super().fetchmany, *args)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = self._timed(super().__next__)
+        self._count_rows(1)
+        return row
+
+
+class TracedConnection(PooledConnection):
+    """PERF_TRACE 开启时连接池使用的连接：游标换成 TracedCursor 并统计提交耗时"""
+
+    def cursor(self, factory=TracedCursor):
+        # conn.execute() 内部也经由这里创建游标
+        return super().cursor(factory)
+
+    def commit(self):
+        trace = current_trace.get()
+        if trace is None:
+            return super().commit()
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            trace.commits += 1
+            trace.commit_ms += (time.perf_counter() - start) * 1000
+
+
+def server_timing_header(trace, total_ms):
+    """Server-Timing 响应头：总耗时、SQL、提交以及各函数（按耗时从高到低）"""
+    parts = [
+        f'total;dur={total_ms:.2f}',
+        f'db;dur={trace.db_ms:.2f};desc="{trace.queries} queries, '
+        f'{trace.rows_read} rows read, {trace.rows_written} rows written"',
+    ]
+    if trace.commits:
+        parts.append(f'commit;dur={trace.commit_ms:.2f};desc="{trace.commits} commits"')
+    for name, (count, ms) in sorted(trace.functions.items(), key=lambda item: -item[1][1]):
+        parts.append(f'{name};dur={ms:.2f}' + (f';desc="x{count}"' if count > 1 else ''))
+    return ', '.join(parts)
+
+
+@app.before_request
+def start_request_trace():
+    if PERF_TRACE:
+        g.perf_token = current_trace.set(RequestTrace())
+
+
+@app.after_request
+def finish_request_trace(response):
+    """记录本请求的统计并附上 Server-Timing 响应头"""
+    trace = current_trace.get()
+    if trace is None:
+        return response
+    total_ms = (time.perf_counter() - trace.start) * 1000
+    rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+    perf_recorder.record_request(f'{request.method} {rule}', trace, total_ms)
+    response.headers['Server-Timing'] = server_timing_header(trace, total_ms)
+    return response
+
+
+@app.teardown_request
+def end_request_trace(exc):
+    token = g.pop('perf_token', None)
+    if token is not None:
+        current_trace.reset(token)
+
+
+# ==================== 任务模板缓存 ====================
+
+class TemplateCache:
+    """按星期预先分好7个桶的模板缓存
+
+    模板只会被管理后台和数据库导入修改，写入方在同一事务里递增
+    app_meta.template_version；读取时比对版本号即可发现其它 worker 的修改。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._buckets = None
+
+    def _load(self, conn):
+        buckets = {weekday: [] for weekday in ALL_WEEKDAYS}
+        cursor = conn.execute('''
+            SELECT w.weekday, t.* FROM template_weekdays w
+            JOIN task_templates t ON t.id = w.template_id
+            ORDER BY w.weekday, w.template_id
+        ''')
+        for row in cursor.fetchall():
+            template = dict(row)
+            buckets[template.pop('weekday')].append(template)
+        return buckets
+
+    def get(self, conn, weekday):
+        """返回某个星期适用的模板；版本号未变时不访问 task_templates"""
+        # 先读版本号再读数据：中间若有写入，只会让缓存在下次读取时多刷新一次
+        version = get_meta_version(conn, 'template_version')
+        with self._lock:
+            if self._buckets is not None and self._version == version:
+                return list(self._buckets[weekday])
+        
+        buckets = self._load(conn)
+        with self._lock:
+            self._version = version
+            self._buckets = buckets
+        return list(buckets[weekday])
+
+    def invalidate(self):
+        """本进程内立即失效（其它 worker 依靠版本号发现）"""
+        with self._lock:
+            self._version = None
+            self._buckets = None
+
+
+@timed
+def get_task_templates(weekday=None, conn=None):
+    """获取任务模板列表"""
+    with borrowed_connection(conn) as conn:
+        if weekday is not None:
+            return current_tenant().template_cache.get(conn, weekday)
+        
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM task_templates ORDER BY id')
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def _select_tasks_by_name(cursor, date_str):
+    """一次取出某天全部任务实例，按任务名称索引"""
+    cursor.execute('''
+        SELECT id, task_name, completed, completed_at, template_id FROM tasks 
+        WHERE date = ?
+    ''', (date_str,))
+    return {row['task_name']: row for row in cursor.fetchall()}
+
+
+def materialize_daily_tasks(conn, date_str, templates):
+    """按集合物化某天的任务实例：一次查询、一次批量插入、一次修正 template_id（不提交事务）"""
     cursor = conn.cursor()
     
-    if weekday is not None:
-        # 使用 ',' || weekdays || ',' 来统一处理各种位置匹配
-        # 例如: weekdays="0,1,2,3,4" 变成 ",0,1,2,3,4,"
-        # 然后匹配 ",3," 即可找到任意位置的 weekday
-        cursor.execute('''
-            SELECT * FROM task_templates 
-            WHERE weekdays = 'all' 
-               OR ',' || weekdays || ',' LIKE ?
-        ''', (f'%,{weekday},%',))
-    else:
-        cursor.execute('SELECT * FROM task_templates ORDER BY id')
+    # 检查当天已存在的任务（通过任务名称精确匹配）
+    existing = _select_tasks_by_name(cursor, date_str)
+    
+    missing = [t for t in templates if t['task_name'] not in existing]
+    # 已存在但关联到旧模板的实例，重新指向当前模板
+    stale = {}
+    for template in templates:
+        row = existing.get(template['task_name'])
+        if row is not None and row['template_id'] != template['id']:
+            stale[row['id']] = template['id']
+    
+    # 快速路径：当天已全部物化，不产生任何写入
+    if missing:
+        # INSERT OR IGNORE 兜住其它 worker 并发插入的同名任务
+        cursor.executemany('''
+            INSERT OR IGNORE INTO tasks (date, task_name, task_type, task_category, template_id, completed)
+            VALUES (?, ?, ?, ?, ?, 0)
+        ''', [(date_str, t['task_name'], t['task_category'], t['task_category'], t['id'])
+              for t in missing])
+    
+    if stale:
+        cases = ' '.join('WHEN ? THEN ?' for _ in stale)
+        placeholders = ','.join('?' for _ in stale)
+        params = [value for pair in stale.items() for value in pair] + list(stale)
+        cursor.execute(f'''
+            UPDATE tasks SET template_id = CASE id {cases} END
+            WHERE id IN ({placeholders})
+        ''', params)
+    
+    if missing:
+        existing = _select_tasks_by_name(cursor, date_str)
+    
+    tasks = []
+    for template in templates:
+        row = existing.get(template['task_name'])
+        if row is None:
+            continue
+        tasks.append({
+            "id": row['id'],
+            "name": template['task_name'],
+            "type": template['task_category'],
+            "category": template['task_category'],
+            "templateId": template['id'],
+            "isSystem": bool(template['is_system']),
+            "completed": bool(row['completed']),
+            "completedAt": row['completed_at']
+        })
     
-    tasks = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return tasks
 
 
-def generate_daily_tasks(date_str=None):
-    """生成指定日期的任务列表"""
+@timed
+def generate_daily_tasks(date_str=None, conn=None):
+    """生成指定日期的任务列表（传入 conn 时由调用方负责提交事务）"""
     if date_str is None:
         date_str = now().strftime('%Y-%m-%d')
     
@@ -250,124 +1136,88 @@ def generate_daily_tasks(date_str=None):
     weekday = date_obj.weekday()
     day_type = DAY_TYPES.get(weekday, "学习日")
     
-    # 获取适用的任务模板
-    templates = get_task_templates(weekday)
+    owns_transaction = conn is None
+    if owns_transaction:
+        conn = get_db_connection()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    try:
+        # 获取适用的任务模板
+        templates = get_task_templates(weekday, conn)
+        tasks = materialize_daily_tasks(conn, date_str, templates)
+        # 只有发生写入时才会开启隐式事务，整批一次提交
+        if owns_transaction and conn.in_transaction:
+            conn.commit()
+    finally:
+        if owns_transaction:
+            release_db_connection(conn)
     
-    tasks = []
+    # 按类别排序：主线在前，支线在后
+    tasks.sort(key=lambda x: (0 if x['category'] == 'main' else 1, x['id']))
     
-    for template in templates:
-        # 检查今日是否已存在该任务（通过任务名称精确匹配）
-        cursor.execute('''
-            SELECT id, completed, completed_at, template_id FROM tasks 
-            WHERE date = ? AND task_name = ?
-        ''', (date_str, template['task_name']))
-        row = cursor.fetchone()
-        
-        if row:
-            # 已存在，更新template_id关联并返回现有记录
-            if row['template_id'] != template['id']:
-                cursor.execute('''
-                    UPDATE tasks SET template_id = ? WHERE id = ?
-                ''', (template['id'], row['id']))
-                conn.commit()
-            
-            tasks.append({
-                "id": row['id'],
-                "name": template['task_name'],
-                "type": template['task_category'],
-                "category": template['task_category'],
-                "templateId": template['id'],
-                "isSystem": bool(template['is_system']),
-                "completed": bool(row['completed']),
-                "completedAt": row['completed_at']
-            })
-        else:
-            # 创建新任务实例，使用INSERT OR IGNORE避免冲突
-            try:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO tasks (date, task_name, task_type, task_category, template_id, completed)
-                    VALUES (?, ?, ?, ?, ?, 0)
-                ''', (date_str, template['task_name'], template['task_category'], 
-                      template['task_category'], template['id']))
-                conn.commit()
-                
-                # 获取刚插入或已存在的记录ID
-                cursor.execute('''
-                    SELECT id, completed, completed_at FROM tasks WHERE date = ? AND task_name = ?
-                ''', (date_str, template['task_name']))
-                row = cursor.fetchone()
-                
-                if row:
-                    tasks.append({
-                        "id": row['id'],
-                        "name": template['task_name'],
-                        "type": template['task_category'],
-                        "category": template['task_category'],
-                        "templateId": template['id'],
-                        "isSystem": bool(template['is_system']),
-                        "completed": bool(row['completed']),
-                        "completedAt": row['completed_at']
-                    })
-            except Exception as e:
-                print(f"Error inserting task {template['task_name']}: {e}")
-                continue
+    return tasks, day_type
+
+
+def project_daily_tasks(conn, date_str):
+    """只读投影：已物化的任务取数据库记录，未物化的按模板在内存中补齐（id 为 None），从不写库"""
+    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+    weekday = date_obj.weekday()
+    day_type = DAY_TYPES.get(weekday, "学习日")
     
-    conn.close()
+    templates = get_task_templates(weekday, conn)
+    existing = _select_tasks_by_name(conn.cursor(), date_str)
     
-    # 按类别排序：主线在前，支线在后
-    tasks.sort(key=lambda x: (0 if x['category'] == 'main' else 1, x['id']))
+    tasks = []
+    for template in templates:
+        row = existing.get(template['task_name'])
+        tasks.append({
+            "id": row['id'] if row else None,
+            "name": template['task_name'],
+            "type": template['task_category'],
+            "category": template['task_category'],
+            "templateId": template['id'],
+            "isSystem": bool(template['is_system']),
+            "completed": bool(row['completed']) if row else False,
+            "completedAt": row['completed_at'] if row else None
+        })
+    
+    # 按类别排序：主线在前，支线在后；虚拟任务排在同类已物化任务之后
+    tasks.sort(key=lambda x: (0 if x['category'] == 'main' else 1,
+                              x['id'] is None, x['id'] or x['templateId']))
     
     return tasks, day_type
 
 
-def update_daily_stats(date_str, day_type=None):
-    """更新每日统计"""
-    conn = get_db_connection()
+@timed
+def compute_daily_stats(conn, date_str):
+    """汇总指定日期的主线/支线完成情况（只读）"""
     cursor = conn.cursor()
     
-    # 统计主线任务
     cursor.execute('''
         SELECT 
+            task_category,
             COUNT(*) as total,
             SUM(completed) as completed
-        FROM tasks WHERE date = ? AND task_category = 'main'
+        FROM tasks WHERE date = ?
+        GROUP BY task_category
     ''', (date_str,))
-    main_row = cursor.fetchone()
-    main_total = main_row['total'] or 0
-    main_completed = main_row['completed'] or 0
-    main_rate = (main_completed / main_total * 100) if main_total > 0 else 0
+    counts = {row['task_category']: (row['total'] or 0, row['completed'] or 0)
+              for row in cursor.fetchall()}
     
-    # 统计支线任务
-    cursor.execute('''
-        SELECT 
-            COUNT(*) as total,
-            SUM(completed) as completed
-        FROM tasks WHERE date = ? AND task_category = 'optional'
-    ''', (date_str,))
-    opt_row = cursor.fetchone()
-    opt_total = opt_row['total'] or 0
-    opt_completed = opt_row['completed'] or 0
+    main_total, main_completed = counts.get('main', (0, 0))
+    opt_total, opt_completed = counts.get('optional', (0, 0))
+    return build_daily_stats(main_total, main_completed, opt_total, opt_completed)
+
+
+def build_daily_stats(main_total, main_completed, opt_total, opt_completed):
+    """由主线/支线的任务数与完成数算出每日统计结构"""
+    main_rate = (main_completed / main_total * 100) if main_total > 0 else 0
     
     total = main_total + opt_total
     total_completed = main_completed + opt_completed
     total_rate = (total_completed / total * 100) if total > 0 else 0
     
     # 主线必须100%完成才算有效打卡
-    is_valid_checkin = 1 if main_completed >= main_total and main_total > 0 else 0
-    
-    cursor.execute('''
-        INSERT OR REPLACE INTO daily_stats 
-        (date, total_tasks, main_tasks, main_completed, optional_tasks, optional_completed,
-         completion_rate, main_completed_rate, day_type, is_valid_checkin)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (date_str, total, main_total, main_completed, opt_total, opt_completed,
-          total_rate, main_rate, day_type, is_valid_checkin))
-    
-    conn.commit()
-    conn.close()
+    is_valid_checkin = main_completed >= main_total and main_total > 0
     
     return {
         "total": total,
@@ -378,42 +1228,275 @@ def update_daily_stats(date_str, day_type=None):
         "mainRate": main_rate,
         "optionalTotal": opt_total,
         "optionalCompleted": opt_completed,
-        "isValidCheckin": bool(is_valid_checkin)
+        "isValidCheckin": is_valid_checkin
     }
 
 
-def get_streak_info():
-    """获取连续打卡信息"""
-    conn = get_db_connection()
+@timed
+def save_daily_stats(conn, date_str, day_type, stats):
+    """整行写入每日统计，并同步累计天数、打卡区间与成就（不提交事务）
+
+    今日快照、漂移修复、补建记录都经过这里：按改写前后的有效打卡/完美状态调整累计天数，
+    只检查受影响的成就，并追加一条 stats 变更（推送给订阅者，同时使 ETag 失效）。
+    与已有记录完全一致时不写库，返回是否发生写入。
+    """
+    values = (stats['total'], stats['mainTotal'], stats['mainCompleted'],
+              stats['optionalTotal'], stats['optionalCompleted'],
+              stats['rate'], stats['mainRate'], day_type, 1 if stats['isValidCheckin'] else 0)
+    
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT total_tasks, main_tasks, main_completed, optional_tasks, optional_completed,
+               completion_rate, main_completed_rate, day_type, is_valid_checkin
+        FROM daily_stats WHERE date = ?
+    ''', (date_str,))
+    row = cursor.fetchone()
+    if row is not None and tuple(row) == values:
+        return False
+    
+    cursor.execute('''
+        INSERT OR REPLACE INTO daily_stats 
+        (date, total_tasks, main_tasks, main_completed, optional_tasks, optional_completed,
+         completion_rate, main_completed_rate, day_type, is_valid_checkin)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (date_str,) + values)
+    
+    # 累计天数按已存储的打卡标记计算（与 compute_lifetime_stats 一致）；没有记录的日子不计入
+    before = (False, False)
+    if row is not None and row['is_valid_checkin']:
+        before = (True, row['optional_completed'] >= row['optional_tasks'])
+    after = day_flags(stats)
+    if row is not None and row['day_type'] != day_type:
+        # 日类型变化时科目天数要从旧类型挪到新类型
+        changed = adjust_lifetime_days(conn, row['day_type'], before, (False, False))
+        changed |= adjust_lifetime_days(conn, day_type, (False, False), after)
+    else:
+        changed = adjust_lifetime_days(conn, day_type, before, after)
+    if update_streak(conn, date_str):
+        changed.add('max_streak')
+    if changed:
+        check_achievements(conn, changed)
+    record_change(conn, 'stats', {"dates": [date_str]})
+    return True
+
+
+def _stats_from_row(row):
+    """daily_stats 记录转换为接口使用的统计结构"""
+    return {
+        "total": row['total_tasks'],
+        "completed": row['main_completed'] + row['optional_completed'],
+        "rate": row['completion_rate'],
+        "mainTotal": row['main_tasks'],
+        "mainCompleted": row['main_completed'],
+        "mainRate": row['main_completed_rate'],
+        "optionalTotal": row['optional_tasks'],
+        "optionalCompleted": row['optional_completed'],
+        "isValidCheckin": bool(row['is_valid_checkin'])
+    }
+
+
+@timed
+def adjust_daily_stats(conn, date_str, day_type, task_category, delta):
+    """按增量更新每日统计（与任务状态更新处于同一事务，不提交）
+
+    比率的算法与 compute_daily_stats 完全一致（先除再乘100），保证增量结果与
+    全量重算逐位相同；当天还没有统计记录时退回全量计算。
+    """
     cursor = conn.cursor()
+    main_delta = delta if task_category == 'main' else 0
+    opt_delta = delta if task_category == 'optional' else 0
+    if delta:
+        cursor.execute('''
+            UPDATE daily_stats SET
+                main_completed = main_completed + ?,
+                optional_completed = optional_completed + ?,
+                completion_rate = CASE WHEN total_tasks > 0
+                    THEN (main_completed + optional_completed + ? + ?) * 1.0 / total_tasks * 100
+                    ELSE 0 END,
+                main_completed_rate = CASE WHEN main_tasks > 0
+                    THEN (main_completed + ?) * 1.0 / main_tasks * 100
+                    ELSE 0 END,
+                is_valid_checkin = CASE WHEN main_tasks > 0 AND main_completed + ? >= main_tasks
+                    THEN 1 ELSE 0 END
+            WHERE date = ?
+        ''', (main_delta, opt_delta, main_delta, opt_delta, main_delta, main_delta, date_str))
     
-    cursor.execute('SELECT * FROM streak_record LIMIT 1')
-    record = cursor.fetchone()
+    cursor.execute('SELECT * FROM daily_stats WHERE date = ?', (date_str,))
+    row = cursor.fetchone()
+    if row is None:
+        # 先按本次变化之前的状态补建记录（同步累计天数），再按增量更新，调用方的累计调整才成立
+        stats = compute_daily_stats(conn, date_str)
+        save_daily_stats(conn, date_str, day_type, build_daily_stats(
+            stats['mainTotal'], stats['mainCompleted'] - main_delta,
+            stats['optionalTotal'], stats['optionalCompleted'] - opt_delta))
+        return adjust_daily_stats(conn, date_str, day_type, task_category, delta)
+    return _stats_from_row(row)
+
+
+@timed
+def reconcile_daily_stats(conn, fix=True):
+    """从 tasks 全量重算 daily_stats，找出增量计数漂移的日期（fix=True 时一并修复，不提交）"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT date,
+            SUM(task_category = 'main') AS main_total,
+            SUM(task_category = 'main' AND completed = 1) AS main_completed,
+            SUM(task_category = 'optional') AS opt_total,
+            SUM(task_category = 'optional' AND completed = 1) AS opt_completed
+        FROM tasks GROUP BY date
+    ''')
+    expected = {row['date']: row for row in cursor.fetchall()}
+    
+    cursor.execute('''
+        SELECT date, total_tasks, main_tasks, main_completed, optional_tasks, optional_completed,
+               completion_rate, main_completed_rate, day_type, is_valid_checkin
+        FROM daily_stats
+    ''')
+    stored = {row['date']: row for row in cursor.fetchall()}
+    
+    drifted = []
+    for date_str in sorted(set(expected) | set(stored)):
+        counts = expected.get(date_str)
+        main_total = counts['main_total'] if counts else 0
+        main_completed = counts['main_completed'] if counts else 0
+        opt_total = counts['opt_total'] if counts else 0
+        opt_completed = counts['opt_completed'] if counts else 0
+        stats = build_daily_stats(main_total, main_completed, opt_total, opt_completed)
+        
+        row = stored.get(date_str)
+        if row is not None:
+            day_type = row['day_type']
+        else:
+            day_type = DAY_TYPES.get(datetime.strptime(date_str, '%Y-%m-%d').weekday(), "学习日")
+        values = (stats['total'], stats['mainTotal'], stats['mainCompleted'],
+                  stats['optionalTotal'], stats['optionalCompleted'],
+                  stats['rate'], stats['mainRate'], day_type, 1 if stats['isValidCheckin'] else 0)
+        if row is not None and tuple(row)[1:] == values:
+            continue
+        
+        drifted.append(date_str)
+        if fix:
+            save_daily_stats(conn, date_str, day_type, stats)
+    
+    return {"checked": len(set(expected) | set(stored)), "drifted": drifted, "fixed": fix}
+
+
+@timed
+def get_streak_info(conn=None):
+    """获取连续打卡信息（只读：断签只体现在返回值中，不回写数据库）
+
+    streak_record 是 checkin_runs 的汇总：最近一段区间的天数和结束日期，以及最长区间天数。
+    """
+    with borrowed_connection(conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM streak_record LIMIT 1')
+        record = cursor.fetchone()
     
     if record is None:
-        conn.close()
         return {"current": 0, "max": 0}
     
     current_streak = record['current_streak']
     max_streak = record['max_streak']
     last_check = record['last_check_date']
-    
     today = now().strftime('%Y-%m-%d')
     yesterday = (now() - timedelta(days=1)).strftime('%Y-%m-%d')
     
+    # 最近一段区间在昨天之前就结束了，说明已经断签
     if last_check == today or last_check == yesterday:
-        conn.close()
         return {"current": current_streak, "max": max_streak}
-    else:
-        cursor.execute('UPDATE streak_record SET current_streak = 0')
-        conn.commit()
-        conn.close()
-        return {"current": 0, "max": max_streak}
+    return {"current": 0, "max": max_streak}
 
 
-def update_streak(date_str):
-    """更新连续打卡天数"""
-    conn = get_db_connection()
+def _shift_date(date_str, days):
+    return (datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def _run_days(start_date, end_date):
+    return (datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')).days + 1
+
+
+def rebuild_checkin_runs(cursor):
+    """从 daily_stats 全量重建打卡区间（gaps-and-islands：日期减去序号相同的行属于同一段）"""
+    cursor.execute('DELETE FROM checkin_runs')
+    cursor.execute('''
+        INSERT INTO checkin_runs (start_date, end_date, days)
+        SELECT MIN(date), MAX(date), COUNT(*)
+        FROM (
+            SELECT date, julianday(date) - ROW_NUMBER() OVER (ORDER BY date) AS island
+            FROM daily_stats
+            WHERE is_valid_checkin = 1
+        )
+        GROUP BY island
+    ''')
+    refresh_streak_record(cursor)
+
+
+def refresh_streak_record(cursor):
+    """用 checkin_runs 的最近一段和最长一段刷新 streak_record；未变化时不写入"""
+    cursor.execute('''
+        SELECT end_date, days FROM checkin_runs
+        WHERE start_date = (SELECT MAX(start_date) FROM checkin_runs)
+    ''')
+    latest = cursor.fetchone()
+    cursor.execute('SELECT MAX(days) FROM checkin_runs')
+    max_streak = cursor.fetchone()[0] or 0
+    current_streak, last_check = (latest[1], latest[0]) if latest else (0, None)
+    
+    cursor.execute('''
+        UPDATE streak_record SET current_streak = ?, max_streak = ?, last_check_date = ?
+        WHERE current_streak IS NOT ? OR max_streak IS NOT ? OR last_check_date IS NOT ?
+    ''', (current_streak, max_streak, last_check, current_streak, max_streak, last_check))
+
+
+def set_checkin_day(cursor, date_str, valid):
+    """把某一天标记为打卡/未打卡，只改动相邻的一到两段区间；返回区间是否发生变化"""
+    cursor.execute('''
+        SELECT start_date, end_date FROM checkin_runs
+        WHERE start_date <= ? ORDER BY start_date DESC LIMIT 1
+    ''', (date_str,))
+    row = cursor.fetchone()
+    containing = row if row and row[1] >= date_str else None
+    
+    if valid:
+        if containing:
+            return False
+        # 与前一天结尾、后一天开头的区间合并
+        prev_run = row if row and row[1] == _shift_date(date_str, -1) else None
+        cursor.execute('SELECT end_date FROM checkin_runs WHERE start_date = ?', (_shift_date(date_str, 1),))
+        next_run = cursor.fetchone()
+        start_date = prev_run[0] if prev_run else date_str
+        end_date = next_run[0] if next_run else date_str
+        if next_run:
+            cursor.execute('DELETE FROM checkin_runs WHERE start_date = ?', (_shift_date(date_str, 1),))
+        cursor.execute('''
+            INSERT OR REPLACE INTO checkin_runs (start_date, end_date, days) VALUES (?, ?, ?)
+        ''', (start_date, end_date, _run_days(start_date, end_date)))
+        return True
+    
+    if not containing:
+        return False
+    # 取消打卡把所在区间一分为二
+    start_date, end_date = containing
+    cursor.execute('DELETE FROM checkin_runs WHERE start_date = ?', (start_date,))
+    if start_date < date_str:
+        left_end = _shift_date(date_str, -1)
+        cursor.execute('''
+            INSERT INTO checkin_runs (start_date, end_date, days) VALUES (?, ?, ?)
+        ''', (start_date, left_end, _run_days(start_date, left_end)))
+    if end_date > date_str:
+        right_start = _shift_date(date_str, 1)
+        cursor.execute('''
+            INSERT INTO checkin_runs (start_date, end_date, days) VALUES (?, ?, ?)
+        ''', (right_start, end_date, _run_days(right_start, end_date)))
+    return True
+
+
+@timed
+def update_streak(conn, date_str):
+    """按 date_str 当天的有效打卡状态增量更新打卡区间与连续打卡天数（不提交事务）
+
+    补打或取消历史日期同样适用：只会合并或拆分相邻区间。返回区间是否发生变化。
+    """
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -421,93 +1504,72 @@ def update_streak(date_str):
     ''', (date_str,))
     row = cursor.fetchone()
     
-    if row and row['is_valid_checkin']:
-        cursor.execute('SELECT * FROM streak_record LIMIT 1')
-        record = cursor.fetchone()
-        
-        last_check = record['last_check_date']
-        yesterday = (datetime.strptime(date_str, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
-        
-        if last_check == yesterday or last_check == date_str:
-            new_streak = record['current_streak'] + 1 if last_check != date_str else record['current_streak']
-            new_max = max(new_streak, record['max_streak'])
-            
-            cursor.execute('''
-                UPDATE streak_record 
-                SET current_streak = ?, max_streak = ?, last_check_date = ?
-            ''', (new_streak, new_max, date_str))
-        else:
-            cursor.execute('''
-                UPDATE streak_record 
-                SET current_streak = 1, last_check_date = ?
-            ''', (date_str,))
-        
-        conn.commit()
-    
-    conn.close()
+    if set_checkin_day(cursor, date_str, bool(row and row['is_valid_checkin'])):
+        refresh_streak_record(cursor)
+        return True
+    return False
 
 
-def get_week_stats():
-    """获取本周7天统计"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+@timed
+def get_week_stats(conn=None):
+    """获取本周7天统计（只读）"""
     today = now()
-    week_data = []
+    dates = [today - timedelta(days=6-i) for i in range(7)]
     
-    for i in range(7):
-        date_obj = today - timedelta(days=6-i)
-        date_str = date_obj.strftime('%Y-%m-%d')
-        weekday = date_obj.weekday()
-        
+    with borrowed_connection(conn) as conn:
+        cursor = conn.cursor()
         cursor.execute('''
-            SELECT * FROM daily_stats WHERE date = ?
-        ''', (date_str,))
-        row = cursor.fetchone()
+            SELECT * FROM daily_stats WHERE date >= ? AND date <= ?
+        ''', (dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d')))
+        rows = {row['date']: row for row in cursor.fetchall()}
         
-        if row:
-            week_data.append({
-                "date": date_str,
-                "weekday": ["一", "二", "三", "四", "五", "六", "日"][weekday],
-                "rate": row['completion_rate'],
-                "mainRate": row['main_completed_rate'],
-                "completed": row['main_completed'],
-                "total": row['main_tasks'],
-                "isValidCheckin": bool(row['is_valid_checkin']),
-                "dayType": row['day_type']
-            })
-        else:
-            tasks, day_type = generate_daily_tasks(date_str)
-            main_tasks = [t for t in tasks if t['category'] == 'main']
-            completed = sum(1 for t in main_tasks if t['completed'])
-            total = len(main_tasks)
-            rate = (completed / total * 100) if total > 0 else 0
+        week_data = []
+        for date_obj in dates:
+            date_str = date_obj.strftime('%Y-%m-%d')
+            weekday = date_obj.weekday()
+            row = rows.get(date_str)
             
-            week_data.append({
-                "date": date_str,
-                "weekday": ["一", "二", "三", "四", "五", "六", "日"][weekday],
-                "rate": rate,
-                "mainRate": rate,
-                "completed": completed,
-                "total": total,
-                "isValidCheckin": completed >= total and total > 0,
-                "dayType": day_type
-            })
+            if row:
+                week_data.append({
+                    "date": date_str,
+                    "weekday": ["一", "二", "三", "四", "五", "六", "日"][weekday],
+                    "rate": row['completion_rate'],
+                    "mainRate": row['main_completed_rate'],
+                    "completed": row['main_completed'],
+                    "total": row['main_tasks'],
+                    "isValidCheckin": bool(row['is_valid_checkin']),
+                    "dayType": row['day_type']
+                })
+            else:
+                tasks, day_type = project_daily_tasks(conn, date_str)
+                main_tasks = [t for t in tasks if t['category'] == 'main']
+                completed = sum(1 for t in main_tasks if t['completed'])
+                total = len(main_tasks)
+                rate = (completed / total * 100) if total > 0 else 0
+                
+                week_data.append({
+                    "date": date_str,
+                    "weekday": ["一", "二", "三", "四", "五", "六", "日"][weekday],
+                    "rate": rate,
+                    "mainRate": rate,
+                    "completed": completed,
+                    "total": total,
+                    "isValidCheckin": completed >= total and total > 0,
+                    "dayType": day_type
+                })
     
-    conn.close()
     return week_data
 
 
-def get_lifetime_stats():
+@timed
+def get_lifetime_stats(conn=None):
     """获取累计学习统计"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM lifetime_stats LIMIT 1')
-    record = cursor.fetchone()
+    with borrowed_connection(conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM lifetime_stats LIMIT 1')
+        record = cursor.fetchone()
     
     if record is None:
-        conn.close()
         return {
             "totalTasks": 0,
             "mainTasks": 0,
@@ -519,7 +1581,6 @@ def get_lifetime_stats():
             "englishDays": 0
         }
     
-    conn.close()
     return {
         "totalTasks": record['total_tasks_completed'],
         "mainTasks": record['main_tasks_completed'],
@@ -532,9 +1593,9 @@ def get_lifetime_stats():
     }
 
 
-def adjust_lifetime_stats(task_category, delta):
-    """调整累计统计"""
-    conn = get_db_connection()
+@timed
+def adjust_lifetime_stats(conn, task_category, delta):
+    """调整累计统计（不提交事务）"""
     cursor = conn.cursor()
     
     if task_category == 'main':
@@ -551,101 +1612,1323 @@ def adjust_lifetime_stats(task_category, delta):
                 optional_tasks_completed = MAX(0, optional_tasks_completed + ?),
                 updated_at = CURRENT_TIMESTAMP
         ''', (delta, delta))
-    
-    conn.commit()
-    conn.close()
 
 
-def check_achievements():
-    """检查并解锁成就"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT achievement_id FROM achievements')
-    unlocked = {row['achievement_id'] for row in cursor.fetchall()}
-    
-    cursor.execute('SELECT * FROM lifetime_stats LIMIT 1')
-    stats = cursor.fetchone()
+def day_flags(stats, main_delta=0, opt_delta=0):
+    """一天是否有效打卡、是否完美（主线+支线全部完成）；传入增量时返回该增量之前的状态"""
+    main_completed = stats['mainCompleted'] - main_delta
+    opt_completed = stats['optionalCompleted'] - opt_delta
+    valid = stats['mainTotal'] > 0 and main_completed >= stats['mainTotal']
+    return valid, valid and opt_completed >= stats['optionalTotal']
+
+
+@timed
+def adjust_lifetime_days(conn, day_type, before, after):
+    """一天的有效打卡/完美状态翻转时，调整学习天数、完美天数和对应科目天数（不提交事务）
+
+    返回发生变化的列名集合。
+    """
+    study_delta = int(after[0]) - int(before[0])
+    perfect_delta = int(after[1]) - int(before[1])
+    if not study_delta and not perfect_delta:
+        return set()
+    
+    sets = ['total_study_days = MAX(0, total_study_days + ?)',
+            'total_perfect_days = MAX(0, total_perfect_days + ?)']
+    params = [study_delta, perfect_delta]
+    changed = {'total_perfect_days'} if perfect_delta else set()
+    if study_delta:
+        changed.add('total_study_days')
+        for column, day_types in DAY_TYPE_COUNTERS.items():
+            if day_type in day_types:
+                sets.append(f'{column} = MAX(0, {column} + ?)')
+                params.append(study_delta)
+                changed.add(column)
+    conn.execute(f"UPDATE lifetime_stats SET {', '.join(sets)}, updated_at = CURRENT_TIMESTAMP", params)
+    return changed
+
+
+class AchievementEngine:
+    """按指标索引的成就规则引擎
+
+    每个进程缓存已解锁集合，以及每个指标下一个尚未达成的阈值；一次打卡只检查
+    本次变化的指标，且只有达到下一个阈值时才需要写库。解锁方在同一事务里递增
+    app_meta.achievement_version，其它 worker 比对版本号即可发现。
+    """
+
+    def __init__(self, achievements):
+        self._rules = {}
+        for ach in achievements.values():
+            self._rules.setdefault(ach['metric'], []).append(ach)
+        for rules in self._rules.values():
+            rules.sort(key=lambda ach: ach['threshold'])
+        self._scopes = {ach['metric']: ach['scope'] for ach in achievements.values()}
+        self._lock = threading.Lock()
+        self._version = None
+        self._unlocked = frozenset()
+        self._next_threshold = {}
+
+    def _state(self, conn):
+        """返回 (已解锁集合, 各指标下一阈值)；版本号未变时不访问 achievements 表"""
+        version = get_meta_version(conn, 'achievement_version')
+        with self._lock:
+            if self._version == version:
+                return self._unlocked, self._next_threshold
+        
+        cursor = conn.execute('SELECT achievement_id FROM achievements')
+        unlocked = frozenset(row[0] for row in cursor.fetchall())
+        next_threshold = {}
+        for metric, rules in self._rules.items():
+            pending = [ach['threshold'] for ach in rules if ach['id'] not in unlocked]
+            if pending:
+                next_threshold[metric] = pending[0]
+        with self._lock:
+            self._version = version
+            self._unlocked = unlocked
+            self._next_threshold = next_threshold
+        return unlocked, next_threshold
+
+    def unlocked(self, conn):
+        return self._state(conn)[0]
+
+    def _read_metrics(self, conn, metrics):
+        """每个 scope 一次单行查询读出所需指标"""
+        values = {}
+        by_scope = {}
+        for metric in metrics:
+            by_scope.setdefault(self._scopes[metric], []).append(metric)
+        for scope, columns in by_scope.items():
+            row = conn.execute(f"SELECT {', '.join(columns)} FROM {ACHIEVEMENT_SCOPES[scope]} LIMIT 1").fetchone()
+            if row:
+                values.update(zip(columns, row))
+        return values
+
+    def evaluate(self, conn, metrics=None):
+        """检查指定指标（默认全部）并解锁达成的成就（不提交事务），返回新解锁的成就"""
+        unlocked, next_threshold = self._state(conn)
+        candidates = [m for m in (self._rules if metrics is None else metrics) if m in next_threshold]
+        if not candidates:
+            return []
+        
+        values = self._read_metrics(conn, candidates)
+        new_achievements = []
+        for metric in candidates:
+            value = values.get(metric) or 0
+            if value < next_threshold[metric]:
+                continue
+            new_achievements.extend(ach for ach in self._rules[metric]
+                                    if ach['id'] not in unlocked and value >= ach['threshold'])
+        
+        if new_achievements:
+            conn.executemany('''
+                INSERT OR IGNORE INTO achievements (achievement_id, name, description, icon)
+                VALUES (?, ?, ?, ?)
+            ''', [(ach['id'], ach['name'], ach['desc'], ach['icon']) for ach in new_achievements])
+            # 本进程的缓存同样依靠版本号刷新：事务回滚时版本号不变，缓存依然有效
+            bump_meta_version(conn, 'achievement_version')
+        return new_achievements
+
+
+@timed
+def check_achievements(conn, metrics=None):
+    """检查并解锁成就（不提交事务）；metrics 为本次变化的指标，None 表示全部检查"""
+    return current_tenant().achievements.evaluate(conn, metrics)
+
+
+@timed
+def get_all_achievements(conn=None):
+    """获取所有成就状态（已解锁集合按版本号缓存）"""
+    with borrowed_connection(conn) as conn:
+        unlocked = current_tenant().achievements.unlocked(conn)
     
-    cursor.execute('SELECT * FROM streak_record LIMIT 1')
-    streak = cursor.fetchone()
-    
-    new_achievements = []
-    
-    if stats:
-        if stats['total_tasks_completed'] >= 1 and 'first_blood' not in unlocked:
-            new_achievements.append('first_blood')
-        if stats['total_tasks_completed'] >= 100 and 'task_master' not in unlocked:
-            new_achievements.append('task_master')
-        if stats['main_tasks_completed'] >= 50 and 'main_master' not in unlocked:
-            new_achievements.append('main_master')
-        if stats['math_days'] >= 10 and 'math_master' not in unlocked:
-            new_achievements.append('math_master')
-        if stats['cs_days'] >= 10 and 'cs_master' not in unlocked:
-            new_achievements.append('cs_master')
-        if stats['english_days'] >= 10 and 'english_master' not in unlocked:
-            new_achievements.append('english_master')
-    
-    if streak:
-        if streak['current_streak'] >= 3 and 'streak_3' not in unlocked:
-            new_achievements.append('streak_3')
-        if streak['current_streak'] >= 7 and 'streak_7' not in unlocked:
-            new_achievements.append('streak_7')
-        if streak['current_streak'] >= 30 and 'streak_30' not in unlocked:
-            new_achievements.append('streak_30')
-    
-    for ach_id in new_achievements:
-        ach = ACHIEVEMENTS[ach_id]
+    return [{**ach, "unlocked": ach_id in unlocked} for ach_id, ach in ACHIEVEMENTS.items()]
+
+
+def get_completed_tasks_by_date(date_str, conn=None):
+    """获取指定日期已完成的任务详情"""
+    with borrowed_connection(conn) as conn:
+        cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO achievements (achievement_id, name, description, icon)
-            VALUES (?, ?, ?, ?)
-        ''', (ach['id'], ach['name'], ach['desc'], ach['icon']))
+            SELECT task_name, task_category, completed_at 
+            FROM tasks 
+            WHERE date = ? AND completed = 1
+            ORDER BY completed_at
+        ''', (date_str,))
+        rows = cursor.fetchall()
     
-    conn.commit()
-    conn.close()
+    tasks = []
+    for row in rows:
+        tasks.append({
+            "name": row['task_name'],
+            "category": row['task_category'],
+            "completedAt": row['completed_at']
+        })
     
-    return [ACHIEVEMENTS[ach_id] for ach_id in new_achievements]
+    return tasks
 
 
-def get_all_achievements():
-    """获取所有成就状态"""
-    conn = get_db_connection()
+# ==================== 全量重算 ====================
+
+LIFETIME_COLUMNS = ('total_tasks_completed', 'main_tasks_completed', 'optional_tasks_completed',
+                    'total_study_days', 'total_perfect_days') + tuple(DAY_TYPE_COUNTERS)
+
+
+def compute_lifetime_stats(conn):
+    """用两次聚合查询从 tasks / daily_stats 算出 lifetime_stats 的全部计数"""
     cursor = conn.cursor()
+    cursor.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(task_category = 'main'), 0),
+               COALESCE(SUM(task_category != 'main'), 0)
+        FROM tasks WHERE completed = 1
+    ''')
+    task_counts = tuple(cursor.fetchone())
+    
+    subject_sums = ', '.join(
+        f"COALESCE(SUM(day_type IN ({', '.join('?' * len(day_types))})), 0)"
+        for day_types in DAY_TYPE_COUNTERS.values()
+    )
+    cursor.execute(f'''
+        SELECT COUNT(*),
+               COALESCE(SUM(optional_completed >= optional_tasks), 0),
+               {subject_sums}
+        FROM daily_stats WHERE is_valid_checkin = 1
+    ''', [t for day_types in DAY_TYPE_COUNTERS.values() for t in day_types])
+    day_counts = tuple(cursor.fetchone())
+    
+    return dict(zip(LIFETIME_COLUMNS, task_counts + day_counts))
+
+
+@timed
+def recompute_aggregates(conn, fix=True):
+    """从 tasks 全量重建 daily_stats、打卡区间、lifetime_stats 并补发成就（不提交）
+
+    全部改动包在一个保存点里：fix=False 时执行完再回滚，只返回差异报告。
+    调用方需已开启写事务。
+    """
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute('SAVEPOINT recompute')
+    try:
+        cursor.execute('SELECT current_streak, max_streak, last_check_date FROM streak_record LIMIT 1')
+        old_streak = tuple(cursor.fetchone() or ())
+        # 修复每日统计时会增量调整累计天数，差异报告以修复前的值为准
+        cursor.execute(f"SELECT {', '.join(LIFETIME_COLUMNS)} FROM lifetime_stats LIMIT 1")
+        row = cursor.fetchone()
+        old_lifetime = dict(row) if row else {}
+        daily = reconcile_daily_stats(conn, fix=True)
+        rebuild_checkin_runs(cursor)
+        cursor.execute('SELECT current_streak, max_streak, last_check_date FROM streak_record LIMIT 1')
+        new_streak = tuple(cursor.fetchone() or ())
+        
+        lifetime = compute_lifetime_stats(conn)
+        lifetime_drift = {column: [old_lifetime.get(column), value]
+                          for column, value in lifetime.items() if old_lifetime.get(column) != value}
+        if lifetime_drift:
+            assignments = ', '.join(f'{c} = ?' for c in LIFETIME_COLUMNS)
+            cursor.execute(f"UPDATE lifetime_stats SET {assignments}, updated_at = CURRENT_TIMESTAMP",
+                           [lifetime[c] for c in LIFETIME_COLUMNS])
+        
+        new_achievements = check_achievements(conn)
+    finally:
+        if not fix:
+            cursor.execute('ROLLBACK TO recompute')
+        cursor.execute('RELEASE recompute')
     
-    cursor.execute('SELECT achievement_id FROM achievements')
-    unlocked = {row['achievement_id'] for row in cursor.fetchall()}
+    return {
+        "checked": daily['checked'],
+        "drifted": daily['drifted'],
+        "streak": {"before": list(old_streak), "after": list(new_streak)} if old_streak != new_streak else None,
+        "lifetime": lifetime_drift,
+        "newAchievements": [a['id'] for a in new_achievements],
+        "changed": bool(daily['drifted'] or old_streak != new_streak or lifetime_drift or new_achievements),
+        "fixed": fix,
+        "elapsedMs": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+# ==================== 今日快照 ====================
+
+@timed
+def _collect_today_snapshot(conn, date_str):
+    """在已开启的事务内读取今日全部数据"""
+    tasks, day_type = generate_daily_tasks(date_str, conn)
+    stats = compute_daily_stats(conn, date_str)
+    # 模板变更可能改变今天是否算有效打卡，统计有变化时同步累计天数、打卡区间与成就
+    save_daily_stats(conn, date_str, day_type, stats)
     
-    conn.close()
+    # 分离主线和支线任务
+    main_tasks = [t for t in tasks if t['category'] == 'main']
+    optional_tasks = [t for t in tasks if t['category'] == 'optional']
     
-    result = []
-    for ach_id, ach in ACHIEVEMENTS.items():
-        result.append({**ach, "unlocked": ach_id in unlocked})
+    return {
+        "date": date_str,
+        "weekday": datetime.strptime(date_str, '%Y-%m-%d').weekday(),
+        "dayType": day_type,
+        "mainTasks": main_tasks,
+        "optionalTasks": optional_tasks,
+        "allTasks": tasks,
+        "completedTasks": get_completed_tasks_by_date(date_str, conn),
+        "stats": stats,
+        "streak": get_streak_info(conn),
+        "lifetime": get_lifetime_stats(conn),
+        "achievements": get_all_achievements(conn)
+    }
+
+
+def build_today_snapshot(date_str=None):
+    """先只读构建今日快照，只有数据确实需要变化时才交给写事务重做"""
+    if date_str is None:
+        date_str = now().strftime('%Y-%m-%d')
     
-    return result
+    # 当天已物化、统计没有漂移时整个快照不产生写入，不必排队等写锁；
+    # 用主库上的只读连接（不读可能落后的 DB_READ_PATH），与 ETag 的版本号同源
+    pool = current_tenant().snapshot_pool
+    conn = pool.acquire()
+    try:
+        with db_transaction(conn):
+            return _collect_today_snapshot(conn, date_str)
+    except sqlite3.OperationalError as e:
+        if not is_readonly_error(e):
+            raise
+    finally:
+        pool.release(conn)
+    return run_write(_collect_today_snapshot, date_str)
+
+
+# ==================== 变更推送 ====================
+
+class ChangeBus:
+    """每个 worker 内每个用户一个的变更通知总线
+
+    有订阅者时由一个后台线程轮询 PRAGMA data_version（任何连接提交都会让它变化，
+    包括其它 gunicorn worker），变化后读取 change_log 的增量广播给本进程的订阅者。
+    没有订阅者时线程退出，空闲的服务端不做任何轮询。
+    """
+
+    def __init__(self, db_path, interval=SSE_POLL_INTERVAL):
+        self.db_path = db_path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self, subscriber=None):
+        """注册一个订阅者，返回接收事件的队列
+
+        subscriber 可传入任何提供 put_nowait/get_nowait/empty 的对象（如 asgi.py 的异步订阅者），
+        默认新建一个有界 queue.Queue。
+        """
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='change-bus', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers) if self._pid == os.getpid() else 0
+
+    def _publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # 客户端消费太慢：丢弃积压，通知它整体刷新一次
+                while not subscriber.empty():
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        break
+                subscriber.put_nowait({"seq": event['seq'], "kind": "resync", "payload": {}})
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA busy_timeout=5000')
+        try:
+            last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            while True:
+                time.sleep(self.interval)
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                try:
+                    current = conn.execute('PRAGMA data_version').fetchone()[0]
+                    if current == data_version:
+                        continue
+                    data_version = current
+                    
+                    max_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+                    if max_seq < last_seq:
+                        # 数据库被整体替换（导入/恢复），序号重新开始
+                        last_seq = max_seq
+                        self._publish({"seq": max_seq, "kind": "resync", "payload": {}})
+                        continue
+                    for event in fetch_changes_since(conn, last_seq):
+                        last_seq = event['seq']
+                        self._publish(event)
+                except sqlite3.Error as e:
+                    app.logger.warning(f"change bus poll failed: {e}")
+        finally:
+            conn.close()
+
+
+def format_sse(event):
+    """格式化为 text/event-stream 消息"""
+    return f"id: {event['seq']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+# ==================== 写入队列 ====================
+
+class WriteQueue:
+    """每个 worker 内每个用户一个的写线程：请求线程提交写操作，写线程成批放进一个写事务（组提交）
+
+    整批只有一次 BEGIN IMMEDIATE、一次提交（一次 fsync）；某个写操作出错时回滚整批，
+    它单独以该异常结束，其余的在新事务里重做（出错很少见，不为每个写操作付 SAVEPOINT 的开销）。
+    批次期间持有 <数据库>.writer.lock 文件锁，多个 worker 的写线程轮流写库，不在 SQLite 的
+    busy_timeout 里互相重试。取不到连接或提交失败时整批以该异常结束，写线程继续处理下一批；
+    没有写操作时线程退出。
+    """
+
+    def __init__(self, name, pool, batch_max=WRITE_BATCH_MAX):
+        self.name = name
+        self.pool = pool
+        self.batch_max = batch_max
+        self.lock_path = pool.db_path + '.writer.lock'
+        self._pid = None
+        self._reset_after_fork()
+
+    def _reset_after_fork(self):
+        # fork 出的子进程没有父进程的写线程，也不处理父进程排队的写操作
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._cond = threading.Condition()
+            self._jobs = []
+            self._thread = None
+            self.batches = self.jobs = self.failures = self.max_batch = 0
+
+    def submit(self, fn, *args):
+        """排队执行 fn(conn, *args)，返回 Future；结果在所在批次提交成功后才可用"""
+        future = Future()
+        self._reset_after_fork()
+        with self._cond:
+            self._jobs.append((fn, args, future, current_trace.get()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'writer-{self.name}', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        """取出下一批写操作；空闲超过 WRITE_IDLE_SECONDS 返回 None"""
+        with self._cond:
+            if not self._jobs:
+                self._cond.wait(WRITE_IDLE_SECONDS)
+            if not self._jobs:
+                self._thread = None
+                return None
+            batch, self._jobs = self._jobs[:self.batch_max], self._jobs[self.batch_max:]
+            return batch
+
+    def _run(self):
+        # 写操作里的 current_tenant() 指向本用户
+        active_tenant.set(self.name)
+        conn = None
+        batch = []
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                try:
+                    if conn is None:
+                        conn = self.pool.acquire()
+                    self._commit_batch(conn, batch)
+                except Exception as e:
+                    # 取不到连接或提交失败：整批都没有写入；连接可能已不可用，关掉后下一批重新取
+                    self._fail(batch, e)
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    app.logger.warning(f"write batch failed for {self.name}: {e}")
+        except BaseException as e:
+            # 线程即将退出：本批与仍在排队的写操作都不会再执行
+            with self._cond:
+                self._thread = None
+                pending, self._jobs = self._jobs, []
+            self._fail(batch or [], e)
+            self._fail(pending, e)
+            raise
+        finally:
+            if conn is not None:
+                self.pool.release(conn)
+
+    def _commit_batch(self, conn, batch):
+        while True:
+            results = []
+            failed = None
+            try:
+                # 等 writer.lock 的时间与等 SQLite 写锁的时间一起计入写锁等待
+                lock_started = time.perf_counter()
+                with file_lock(self.lock_path), db_transaction(conn, immediate=True, lock_started=lock_started):
+                    for fn, args, future, trace in batch:
+                        # 调用方等待超时、已取消的写操作不再执行
+                        if not (future.running() or future.set_running_or_notify_cancel()):
+                            continue
+                        # 写操作的 SQL 计入提交它的请求的追踪记录
+                        token = current_trace.set(trace)
+                        try:
+                            results.append((future, fn(conn, *args)))
+                        except Exception as e:
+                            failed = future, e
+                            raise
+                        finally:
+                            current_trace.reset(token)
+            except Exception:
+                if failed is None:
+                    raise
+                # 某个写操作出错：整批已回滚，它单独以该异常结束，其余的放进新事务重做
+                future, error = failed
+                future.set_exception(error)
+                self._count(1, 1)
+                batch = [job for job in batch if not job[2].done()]
+                continue
+            for future, result in results:
+                future.set_result(result)
+            if results:
+                self._count(len(results), 0)
+            return
+
+    def _fail(self, batch, error):
+        """让批次中还没有结果的写操作都以 error 结束"""
+        failed = 0
+        for _, _, future, _ in batch:
+            if future.done():
+                continue
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(error)
+                failed += 1
+        if failed:
+            self._count(failed, failed)
+
+    def _count(self, size, failures):
+        with self._cond:
+            self.batches += 1
+            self.jobs += size
+            self.failures += failures
+            self.max_batch = max(self.max_batch, size)
+        worker_metrics.inc('dashboard_sqlite_write_batches_total')
+        worker_metrics.inc('dashboard_sqlite_write_jobs_total', value=size)
+
+    def stats(self):
+        """排队数、批次数与平均批大小"""
+        self._reset_after_fork()
+        with self._cond:
+            return {
+                "enabled": DB_WRITE_QUEUE,
+                "running": self._thread is not None,
+                "queued": len(self._jobs),
+                "batches": self.batches,
+                "jobs": self.jobs,
+                "failures": self.failures,
+                "maxBatch": self.max_batch,
+                "avgBatch": (self.jobs / self.batches) if self.batches > 0 else 0
+            }
+
+
+class WriteTimeout(RuntimeError):
+    """写操作在 WRITE_TIMEOUT 秒内没有等到写线程提交"""
+
+
+def run_write(fn, *args):
+    """在写事务内执行 fn(conn, *args) 并返回其结果；fn 抛出的异常原样抛给调用方
+
+    DB_WRITE_QUEUE 开启时交给当前用户的写线程与其它请求的写操作合并提交，
+    否则在本请求的连接上开启 BEGIN IMMEDIATE 直接执行。等待超时抛出 WriteTimeout：
+    还在排队的写操作被取消，已经开始执行的仍会提交。
+    """
+    if DB_WRITE_QUEUE:
+        future = current_tenant().writer.submit(fn, *args)
+        try:
+            return future.result(timeout=WRITE_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            raise WriteTimeout(f"写入等待超过 {WRITE_TIMEOUT:g} 秒") from None
+    conn = get_db_connection()
+    with db_transaction(conn, immediate=True):
+        return fn(conn, *args)
+
+
+# ==================== 多用户 ====================
+
+TENANT_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')
+TENANT_PREFIX_PATTERN = re.compile(r'^/u/([^/]+)(/.*)?$')
+# 请求之外（命令行、后台线程）操作的用户
+active_tenant = contextvars.ContextVar('active_tenant', default=DEFAULT_TENANT)
+
+
+class UnknownTenant(LookupError):
+    """用户名不合法或对应的数据库不存在"""
+
+
+class Tenant:
+    """一个用户在本进程内的全部状态：数据库文件、连接池、缓存、变更总线和快照目录"""
+
+    def __init__(self, name, db_path):
+        is_default = name == DEFAULT_TENANT
+        pool_size = DB_POOL_SIZE if is_default else TENANT_POOL_SIZE
+        self.name = name
+        self.db_path = db_path
+        self.backup_dir = BACKUP_DIR if is_default else os.path.join(BACKUP_DIR, name)
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.read_pool = ConnectionPool(DB_READ_PATH if is_default else db_path, pool_size, readonly=True)
+        # 主库上的只读连接：DB_READ_PATH 就是主库时与 read_pool 共用
+        if self.read_pool.db_path == db_path:
+            self.snapshot_pool = self.read_pool
+        else:
+            self.snapshot_pool = ConnectionPool(db_path, pool_size, readonly=True)
+        self.template_cache = TemplateCache()
+        self.achievements = AchievementEngine(ACHIEVEMENTS)
+        self.change_bus = ChangeBus(db_path)
+        self.writer = WriteQueue(name, self.pool)
+
+    def close(self):
+        self.pool.close()
+        self.read_pool.close()
+        self.snapshot_pool.close()
+
+
+class TenantRegistry:
+    """按用户名懒加载 Tenant，超过 TENANT_MAX_OPEN 时关闭最久未用的用户的空闲连接"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = OrderedDict()
+
+    def path_for(self, name):
+        """用户名对应的数据库文件；不合法的用户名返回 None"""
+        if name == DEFAULT_TENANT:
+            return DB_PATH
+        if not TENANTS_DIR or not TENANT_NAME_PATTERN.match(name or ''):
+            return None
+        return os.path.join(TENANTS_DIR, f'{name}.db')
+
+    def get(self, name):
+        with self._lock:
+            tenant = self._open.get(name)
+            if tenant is not None:
+                self._open.move_to_end(name)
+                return tenant
+        
+        path = self.path_for(name)
+        if path is None or (name != DEFAULT_TENANT and not os.path.exists(path)):
+            raise UnknownTenant(name)
+        migrate_database(path)
+        
+        with self._lock:
+            tenant = self._open.get(name)
+            if tenant is None:
+                tenant = self._open[name] = Tenant(name, path)
+                self._evict()
+            return tenant
+
+    def _evict(self):
+        for name in list(self._open):
+            if len(self._open) <= TENANT_MAX_OPEN:
+                break
+            tenant = self._open[name]
+            # 默认用户和有推送订阅者的用户常驻
+            if name == DEFAULT_TENANT or tenant.change_bus.subscriber_count():
+                continue
+            del self._open[name]
+            tenant.close()
+
+    def create(self, name):
+        """新建用户数据库，返回 Tenant；用户已存在时抛出 FileExistsError"""
+        path = self.path_for(name)
+        if path is None or name == DEFAULT_TENANT:
+            raise UnknownTenant(name)
+        os.makedirs(TENANTS_DIR, exist_ok=True)
+        # O_EXCL 保证并发创建同名用户时只有一个成功
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return self.get(name)
+
+    def names(self):
+        """所有用户名（默认用户在前）"""
+        names = [DEFAULT_TENANT]
+        if TENANTS_DIR and os.path.isdir(TENANTS_DIR):
+            names.extend(sorted(
+                filename[:-3] for filename in os.listdir(TENANTS_DIR)
+                if filename.endswith('.db') and TENANT_NAME_PATTERN.match(filename[:-3])
+            ))
+        return names
+
+    def subscriber_count(self):
+        with self._lock:
+            tenants = list(self._open.values())
+        return sum(tenant.change_bus.subscriber_count() for tenant in tenants)
+
+    def open_count(self):
+        with self._lock:
+            return len(self._open)
+
+
+tenants = TenantRegistry()
+
+
+def resolve_tenant_name():
+    """按 请求头 X-Dashboard-User（仅 TRUST_USER_HEADER）→ ?user= → /u/<用户>/ 路径前缀 的顺序确定当前用户
+
+    只看本次请求本身，不记在会话里：同一浏览器的多个标签页各自访问不同用户时互不串扰。
+    """
+    candidates = (
+        request.headers.get('X-Dashboard-User') if TRUST_USER_HEADER else None,
+        request.args.get('user'),
+        request.environ.get('dashboard.tenant'),
+    )
+    return next((name for name in candidates if name), DEFAULT_TENANT)
+
+
+def current_tenant():
+    """请求内按 resolve_tenant_name() 解析并缓存在 g 上；请求之外使用 active_tenant"""
+    if has_request_context():
+        tenant = g.get('tenant')
+        if tenant is None:
+            tenant = g.tenant = tenants.get(resolve_tenant_name())
+        return tenant
+    return tenants.get(active_tenant.get())
+
+
+@contextmanager
+def use_tenant(name):
+    """在请求之外（命令行、后台线程）切换当前用户"""
+    token = active_tenant.set(name)
+    try:
+        yield tenants.get(name)
+    finally:
+        active_tenant.reset(token)
+
+
+class TenantPrefixMiddleware:
+    """把 /u/<用户>/... 转成 /...，用户名放进 environ，页面与接口无需为多用户单独注册路由"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        match = TENANT_PREFIX_PATTERN.match(environ.get('PATH_INFO', ''))
+        if match:
+            environ['dashboard.tenant'] = match.group(1)
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + f'/u/{match.group(1)}'
+            environ['PATH_INFO'] = match.group(2) or '/'
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = TenantPrefixMiddleware(app.wsgi_app)
+
+
+@app.before_request
+def bind_tenant():
+    """请求开始时解析用户，不存在的用户在进入接口之前就返回 404"""
+    current_tenant()
+
+
+@app.errorhandler(UnknownTenant)
+def handle_unknown_tenant(e):
+    return jsonify({"error": f"用户不存在: {e}"}), 404
+
+
+@app.errorhandler(WriteTimeout)
+def handle_write_timeout(e):
+    return jsonify({"success": False, "error": f"数据库繁忙，请稍后重试: {e}"}), 503
+
+
+# ==================== 数据库备份 ====================
+
+# 导入的数据库至少要包含这些表
+REQUIRED_TABLES = {'task_templates', 'tasks', 'daily_stats'}
+
+
+def backup_database(dest_path, pages=BACKUP_PAGES_PER_STEP):
+    """用 SQLite 在线备份 API 把主库分页复制为独立的单文件快照（包含尚未检查点的 WAL 内容）"""
+    src = sqlite3.connect(current_tenant().db_path, timeout=10.0)
+    dst = sqlite3.connect(dest_path)
+    try:
+        src.backup(dst, pages=pages, sleep=BACKUP_STEP_SLEEP)
+        # 快照不带 -wal/-shm，下载或归档后可直接打开
+        dst.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        dst.close()
+        src.close()
+
+
+def iter_gzip_file(path, remove=False, chunk_size=64 * 1024):
+    """分块读取文件并以 gzip 格式流式压缩输出"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+        yield compressor.flush()
+    finally:
+        if remove:
+            os.remove(path)
+
+
+def save_stream_to_temp(stream, directory):
+    """把上传文件或快照存为同目录下的临时文件，gzip 压缩的备份自动解压"""
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.import')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            head = stream.read(2)
+            if head == b'\x1f\x8b':
+                decompressor = zlib.decompressobj(31)
+                out.write(decompressor.decompress(head))
+                for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                    out.write(decompressor.decompress(chunk))
+                out.write(decompressor.flush())
+            else:
+                out.write(head)
+                for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                    out.write(chunk)
+    except (OSError, zlib.error):
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def validate_database_file(path):
+    """校验上传的数据库：能打开、integrity_check 通过、包含必需的表；返回错误信息或 None"""
+    try:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            if conn.execute('PRAGMA integrity_check').fetchone()[0] != 'ok':
+                return '数据库文件已损坏'
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return '不是有效的 SQLite 数据库文件'
+    
+    missing = REQUIRED_TABLES - tables
+    if missing:
+        return f"缺少数据表: {', '.join(sorted(missing))}"
+    return None
+
+
+def restore_database(source_path):
+    """把已校验的数据库整体替换进主库
+
+    通过备份 API 一次性写入正在使用的主库文件：整个复制是一个写事务，其它连接
+    （包括其它 worker）在此期间按 busy_timeout 等待，完成后直接读到新数据，
+    不存在替换文件后旧连接仍指向旧 inode 的问题。
+    """
+    tenant = current_tenant()
+    conn = get_db_connection()
+    # 持有写线程的文件锁，各 worker 的写线程在替换完成后才继续写库
+    with file_lock(tenant.writer.lock_path):
+        previous_versions = {key: get_meta_version(conn, key) for key in ('template_version', 'achievement_version')}
+        
+        src = sqlite3.connect(source_path)
+        try:
+            src.backup(conn)
+        finally:
+            src.close()
+        
+        # 导入后的缓存版本必须大于旧库，其它 worker 才能发现缓存失效
+        for key, previous_version in previous_versions.items():
+            bump_meta_version(conn, key, previous_version)
+        record_change(conn, 'import')
+        conn.commit()
+    release_db_connection(conn)
+    tenant.template_cache.invalidate()
+
+
+def restore_from_temp(temp_path):
+    """校验临时库 → 迁移表结构 → 快照当前主库 → 整体替换；返回 (错误信息, 恢复前快照)"""
+    error = validate_database_file(temp_path)
+    if error:
+        return error, None
+    
+    # 把旧版本的表结构迁移到当前版本
+    migrate_database(temp_path)
+    snapshot = take_snapshot('pre-restore')
+    restore_database(temp_path)
+    return None, snapshot
+
+
+# ==================== 定时快照 ====================
+
+SNAPSHOT_PATTERN = re.compile(r'^snapshot-(\d{8}-\d{6})(?:-([a-z-]+))?\.db\.gz$')
+# 旧版导入时留在数据目录下的 operations.db.backup.YYYYmmddHHMMSS
+LEGACY_BACKUP_PATTERN = re.compile(r'^' + re.escape(os.path.basename(DB_PATH)) + r'\.backup\.(\d{14})$')
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """跨进程文件锁；非阻塞模式下拿不到锁时返回 False"""
+    if fcntl is None:
+        yield True
+        return
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def list_snapshots():
+    """列出当前用户的全部快照（默认用户含旧版导入备份），按时间从新到旧"""
+    tenant = current_tenant()
+    snapshots = []
+    sources = [(tenant.backup_dir, SNAPSHOT_PATTERN, '%Y%m%d-%H%M%S')]
+    if tenant.name == DEFAULT_TENANT:
+        sources.append((os.path.dirname(DB_PATH), LEGACY_BACKUP_PATTERN, '%Y%m%d%H%M%S'))
+    for directory, pattern, time_format in sources:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if not match:
+                continue
+            path = os.path.join(directory, name)
+            kind = 'legacy' if pattern is LEGACY_BACKUP_PATTERN else (match.group(2) or 'scheduled')
+            snapshots.append({
+                "name": name,
+                "path": path,
+                "kind": kind,
+                "size": os.path.getsize(path),
+                "createdAt": datetime.strptime(match.group(1), time_format),
+            })
+    snapshots.sort(key=lambda s: (s['createdAt'], s['name']), reverse=True)
+    return snapshots
+
+
+def find_snapshot(name):
+    """按文件名查找快照，只接受 list_snapshots 列出的文件，防止路径穿越"""
+    for snapshot in list_snapshots():
+        if snapshot['name'] == name:
+            return snapshot
+    return None
+
 
+def snapshot_info(snapshot):
+    """快照的 JSON 表示"""
+    return {
+        "name": snapshot['name'],
+        "kind": snapshot['kind'],
+        "size": snapshot['size'],
+        "createdAt": snapshot['createdAt'].strftime('%Y-%m-%d %H:%M:%S'),
+    }
 
-def get_completed_tasks_by_date(date_str):
-    """获取指定日期已完成的任务详情"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT task_name, task_category, completed_at 
-        FROM tasks 
-        WHERE date = ? AND completed = 1
-        ORDER BY completed_at
-    ''', (date_str,))
-    
-    tasks = []
-    for row in cursor.fetchall():
-        tasks.append({
-            "name": row['task_name'],
-            "category": row['task_category'],
-            "completedAt": row['completed_at']
-        })
+
+def take_snapshot(tag=None):
+    """在线备份当前用户的数据库并 gzip 压缩存入其快照目录，写完后原子改名"""
+    backup_dir = current_tenant().backup_dir
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = now().strftime('%Y%m%d-%H%M%S')
+    name = f"snapshot-{stamp}-{tag}.db.gz" if tag else f"snapshot-{stamp}.db.gz"
+    path = os.path.join(backup_dir, name)
     
-    conn.close()
-    return tasks
+    fd, raw_path = tempfile.mkstemp(dir=backup_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        backup_database(raw_path)
+        with open(path + '.tmp', 'wb') as out:
+            for chunk in iter_gzip_file(raw_path):
+                out.write(chunk)
+        os.replace(path + '.tmp', path)
+    finally:
+        for leftover in (raw_path, path + '.tmp'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return find_snapshot(name)
+
+
+def select_retained(snapshots, daily=None, weekly=None, monthly=None):
+    """祖父-父-子（GFS）保留策略：最新一份始终保留，再按日/ISO 周/月各保留最近 N 个周期的最新快照"""
+    daily = BACKUP_KEEP_DAILY if daily is None else daily
+    weekly = BACKUP_KEEP_WEEKLY if weekly is None else weekly
+    monthly = BACKUP_KEEP_MONTHLY if monthly is None else monthly
+    keep = {snapshots[0]['name']} if snapshots else set()
+    periods = (
+        (lambda t: t.date(), daily),
+        (lambda t: t.isocalendar()[:2], weekly),
+        (lambda t: (t.year, t.month), monthly),
+    )
+    for period_of, limit in periods:
+        seen = set()
+        for snapshot in snapshots:
+            period = period_of(snapshot['createdAt'])
+            if period in seen:
+                continue
+            if len(seen) >= limit:
+                break
+            seen.add(period)
+            keep.add(snapshot['name'])
+    return keep
+
+
+def prune_snapshots():
+    """按保留策略删除多余快照，返回被删除的文件名"""
+    snapshots = list_snapshots()
+    keep = select_retained(snapshots)
+    removed = []
+    for snapshot in snapshots:
+        if snapshot['name'] not in keep:
+            os.remove(snapshot['path'])
+            removed.append(snapshot['name'])
+    return removed
+
+
+class BackupScheduler:
+    """每个 worker 一个后台线程定期检查；通过文件锁保证多 worker 同一时刻只有一个在做快照"""
+    
+    def __init__(self, interval_hours):
+        self.interval = timedelta(hours=interval_hours)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+    
+    def ensure_started(self):
+        if self.interval <= timedelta(0):
+            return
+        with self._lock:
+            # fork 之后线程不会被继承，按进程号判断是否需要重新启动
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+            self._thread.start()
+    
+    def run_once(self):
+        """依次检查每个用户，距上次快照超过间隔时做一次快照并清理；返回新快照列表"""
+        created = []
+        for name in tenants.names():
+            try:
+                with use_tenant(name):
+                    snapshot = self._run_for_current_tenant()
+            except (OSError, sqlite3.Error, UnknownTenant) as e:
+                # 单个用户失败不影响其他用户的快照
+                app.logger.warning('用户 %s 定时快照失败: %s', name, e)
+                continue
+            if snapshot:
+                created.append(snapshot)
+        return created
+    
+    def _run_for_current_tenant(self):
+        backup_dir = current_tenant().backup_dir
+        os.makedirs(backup_dir, exist_ok=True)
+        with file_lock(os.path.join(backup_dir, '.scheduler.lock'), blocking=False) as locked:
+            if not locked:
+                return None
+            latest = next((s for s in list_snapshots() if s['kind'] != 'legacy'), None)
+            if latest and now().replace(tzinfo=None) - latest['createdAt'] < self.interval:
+                return None
+            snapshot = take_snapshot()
+            prune_snapshots()
+            return snapshot
+    
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except (OSError, sqlite3.Error) as e:
+                app.logger.warning('定时快照失败: %s', e)
+            time.sleep(BACKUP_CHECK_INTERVAL)
+
+
+backup_scheduler = BackupScheduler(BACKUP_INTERVAL_HOURS)
+
+
+@app.before_request
+def start_backup_scheduler():
+    backup_scheduler.ensure_started()
+
+
+# ==================== 监控指标 ====================
+
+# 请求耗时直方图的桶上界（秒）
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# BEGIN IMMEDIATE（写线程还包括等 writer.lock）超过该时长（秒）视为等待了其它连接持有的写锁
+LOCK_WAIT_THRESHOLD = 0.001
+WORKER_METRICS_PATTERN = re.compile(r'^worker-(\d+)-\d+\.json$')
+METRICS_HELP = {
+    'dashboard_http_requests_total': ('counter', '按接口、方法、状态码统计的请求数'),
+    'dashboard_http_request_duration_seconds': ('histogram', '按接口、方法统计的请求耗时'),
+    'dashboard_sqlite_write_transactions_total': ('counter', 'BEGIN IMMEDIATE 写事务数'),
+    'dashboard_sqlite_lock_waits_total': ('counter', '等待写锁超过 1ms 的写事务数'),
+    'dashboard_sqlite_lock_wait_seconds_total': ('counter', '等待写锁的累计时长'),
+    'dashboard_sqlite_lock_errors_total': ('counter', 'database is locked / busy 错误数'),
+    'dashboard_sqlite_write_batches_total': ('counter', '写线程提交的批次数'),
+    'dashboard_sqlite_write_jobs_total': ('counter', '写线程执行的写操作数（除以批次数即平均批大小）'),
+    'dashboard_db_size_bytes': ('gauge', '数据库文件大小'),
+    'dashboard_db_wal_size_bytes': ('gauge', 'WAL 文件大小'),
+    'dashboard_tasks': ('gauge', '任务行数'),
+    'dashboard_tasks_completed': ('gauge', '已完成的任务行数'),
+}
+
+
+class WorkerMetrics:
+    """每个 worker 一份的计数器与直方图
+
+    请求路径上只做内存累加；后台线程每 METRICS_FLUSH_INTERVAL 秒把全量计数原子写入
+    METRICS_DIR/worker-<pid>-<启动时间>.json。/metrics 汇总所有 worker 的文件，
+    已退出的 worker 的文件并入 archive.json，计数始终单调递增。
+    """
+
+    def __init__(self, directory, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset_after_fork()
+        atexit.register(self.flush)
+
+    def _reset_after_fork(self):
+        # gunicorn fork 出的子进程从零开始计数，写自己的文件
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f'worker-{self._pid}-{int(time.time() * 1000)}.json')
+            self._counters = {}
+            self._histograms = {}
+            self._dirty = False
+            self._thread = None
+
+    def _touch(self):
+        self._dirty = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._reset_after_fork()
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._touch()
+
+    def observe(self, name, labels, value, buckets=METRICS_LATENCY_BUCKETS):
+        with self._lock:
+            self._reset_after_fork()
+            key = (name, labels)
+            state = self._histograms.get(key)
+            if state is None:
+                # 各桶（不累计）的计数，最后一个为 +Inf；然后是总和与总数
+                state = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+            self._touch()
+
+    def record_request(self, endpoint, method, status, seconds):
+        self.inc('dashboard_http_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status))))
+        self.observe('dashboard_http_request_duration_seconds', (('endpoint', endpoint), ('method', method)), seconds)
+
+    def record_lock_wait(self, seconds):
+        self.inc('dashboard_sqlite_write_transactions_total')
+        if seconds > LOCK_WAIT_THRESHOLD:
+            self.inc('dashboard_sqlite_lock_waits_total')
+            self.inc('dashboard_sqlite_lock_wait_seconds_total', value=seconds)
+
+    def record_lock_error(self, exc):
+        if isinstance(exc, sqlite3.OperationalError) and is_lock_error(exc):
+            self.inc('dashboard_sqlite_lock_errors_total')
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                app.logger.warning('写入监控计数失败: %s', e)
+
+    def flush(self):
+        """把本 worker 的计数写入自己的文件（先写临时文件再改名）"""
+        with self._lock:
+            if not self._dirty or self._pid != os.getpid():
+                return
+            data = self._dump(self._counters, self._histograms)
+            self._dirty = False
+            path = self._path
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _dump(counters, histograms):
+        """转成可 JSON 序列化的列表形式"""
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, list(labels), *state] for (name, labels), state in histograms.items()],
+        }
+
+    @staticmethod
+    def _merge(total, data):
+        for name, labels, value in data.get('counters', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            total['counters'][key] = total['counters'].get(key, 0) + value
+        for name, labels, counts, value_sum, count in data.get('histograms', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            state = total['histograms'].setdefault(key, [[0] * len(counts), 0.0, 0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += value_sum
+            state[2] += count
+
+    @staticmethod
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def collect(self):
+        """汇总所有 worker（含已退出的）的计数，返回 {'counters': {...}, 'histograms': {...}}"""
+        self.flush()
+        total = {'counters': {}, 'histograms': {}}
+        if not os.path.isdir(self.directory):
+            return total
+        archive_path = os.path.join(self.directory, 'archive.json')
+        with file_lock(os.path.join(self.directory, '.archive.lock')):
+            archive = {'counters': {}, 'histograms': {}}
+            if os.path.exists(archive_path):
+                with open(archive_path) as f:
+                    self._merge(archive, json.load(f))
+            
+            dead = []
+            for filename in os.listdir(self.directory):
+                match = WORKER_METRICS_PATTERN.match(filename)
+                if not match:
+                    continue
+                path = os.path.join(self.directory, filename)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                alive = self._pid_alive(int(match.group(1)))
+                self._merge(total if alive else archive, data)
+                if not alive and fcntl is not None:
+                    dead.append(path)
+            
+            if dead:
+                # 已退出 worker 的计数并入 archive.json 后删除其文件
+                data = self._dump(archive['counters'], archive['histograms'])
+                fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(temp_path, archive_path)
+                for path in dead:
+                    os.remove(path)
+        
+        self._merge(total, self._dump(archive['counters'], archive['histograms']))
+        return total
+
+
+worker_metrics = WorkerMetrics(METRICS_DIR)
+
+
+def collect_database_gauges():
+    """每个用户的数据库文件大小、WAL 大小和任务行数，返回 [(指标名, 标签, 值)]"""
+    gauges = []
+    for name in tenants.names():
+        db_path = tenants.path_for(name)
+        if not os.path.exists(db_path):
+            continue
+        labels = (('tenant', name),)
+        wal_path = db_path + '-wal'
+        gauges.append(('dashboard_db_size_bytes', labels, os.path.getsize(db_path)))
+        gauges.append(('dashboard_db_wal_size_bytes', labels, os.path.getsize(wal_path) if os.path.exists(wal_path) else 0))
+        try:
+            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=1.0)
+            try:
+                total, completed = conn.execute('SELECT COUNT(*), COALESCE(SUM(completed), 0) FROM tasks').fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            continue
+        gauges.append(('dashboard_tasks', labels, total))
+        gauges.append(('dashboard_tasks_completed', labels, completed))
+    return gauges
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_metrics():
+    """生成 Prometheus 文本格式（text/plain; version=0.0.4）"""
+    collected = worker_metrics.collect()
+    series = {}
+    for (name, labels), value in sorted(collected['counters'].items()):
+        series.setdefault(name, []).append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), (counts, value_sum, count) in sorted(collected['histograms'].items()):
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, bucket_count in zip(list(METRICS_LATENCY_BUCKETS) + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {value_sum}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    for name, labels, value in collect_database_gauges():
+        series.setdefault(name, []).append(f'{name}{_format_labels(labels)} {value}')
+    
+    output = []
+    for name, (metric_type, help_text) in METRICS_HELP.items():
+        if name not in series:
+            continue
+        output.append(f'# HELP {name} {help_text}')
+        output.append(f'# TYPE {name} {metric_type}')
+        output.extend(series[name])
+    return '\n'.join(output) + '\n'
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        # 按路由规则而不是实际路径统计，标签数量有界
+        endpoint = request.url_rule.rule if request.url_rule else '<unmatched>'
+        worker_metrics.record_request(endpoint, request.method, response.status_code, time.perf_counter() - start)
+    return response
 
 
 # ==================== 登录验证装饰器 ====================
@@ -659,6 +2942,49 @@ def admin_required(f):
     return decorated_function
 
 
+# ==================== 条件请求（ETag） ====================
+
+def current_data_version(conn):
+    """廉价的数据版本：最新变更序号 + 模板版本，两次主键查询即可得到"""
+    row = conn.execute('''
+        SELECT (SELECT COALESCE(MAX(seq), 0) FROM change_log),
+               (SELECT value FROM app_meta WHERE key = 'template_version')
+    ''').fetchone()
+    return f"{row[0]}.{row[1]}"
+
+
+def etag_cached(f=None, readonly=False):
+    """为只读接口生成强 ETag；If-None-Match 命中时直接返回 304，不执行接口逻辑
+
+    所有写入路径都会追加 change_log 或递增模板版本（今日快照、漂移修复对每日统计的改写
+    由 save_daily_stats 记录，见 bench/check_etags.py），再加上日期（连续打卡、本周统计
+    随日期变化）和请求路径，就能唯一确定响应内容。版本号必须从构建响应的同一个库读取：响应读只读连接（可能是 DB_READ_PATH 副本）的接口写作 @etag_cached(readonly=True)，
+    否则副本落后时主库已变化的数据会被答成 304。
+    """
+    if f is None:
+        return lambda f: etag_cached(f, readonly)
+    
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # 与接口本身共用本请求的连接
+        conn = get_db_connection(readonly=readonly)
+        version = current_data_version(conn)
+        key = f"{current_tenant().name}|{request.full_path}|{now().strftime('%Y-%m-%d')}|{version}"
+        etag = hashlib.sha1(key.encode()).hexdigest()
+        
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        # 允许浏览器缓存，但每次使用前都要带 If-None-Match 重新验证
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return decorated_function
+
+
 # ==================== 页面路由 ====================
 
 @app.route('/')
@@ -691,102 +3017,105 @@ def admin_login_page():
 
 
 @app.route('/api/today')
+@etag_cached
 def get_today():
     """获取今日任务列表+状态"""
-    date_str = now().strftime('%Y-%m-%d')
-    tasks, day_type = generate_daily_tasks(date_str)
-    stats = update_daily_stats(date_str, day_type)
-    streak = get_streak_info()
-    lifetime = get_lifetime_stats()
-    achievements = get_all_achievements()
-    completed_tasks = get_completed_tasks_by_date(date_str)
-    
-    # 分离主线和支线任务
-    main_tasks = [t for t in tasks if t['category'] == 'main']
-    optional_tasks = [t for t in tasks if t['category'] == 'optional']
-    
-    return jsonify({
-        "date": date_str,
-        "weekday": now().weekday(),
-        "dayType": day_type,
-        "mainTasks": main_tasks,
-        "optionalTasks": optional_tasks,
-        "allTasks": tasks,
-        "completedTasks": completed_tasks,
-        "stats": stats,
-        "streak": streak,
-        "lifetime": lifetime,
-        "achievements": achievements
-    })
+    return jsonify(build_today_snapshot())
 
 
-@app.route('/api/task/<int:task_id>', methods=['POST'])
-def toggle_task(task_id):
-    """切换任务完成状态"""
-    date_str = now().strftime('%Y-%m-%d')
-    data = request.get_json() or {}
-    new_completed = data.get('completed', True)
-    
-    conn = get_db_connection()
+@timed
+def apply_task_toggle(conn, date_str, task_id, new_completed):
+    """在调用方的写事务内完成一次打卡切换；状态未变化时不做任何写入
+
+    返回 None 表示任务不存在。
+    """
     cursor = conn.cursor()
     
-    # 获取任务当前状态
+    # 获取任务当前状态（已持有写锁，读到的就是最新状态）
     cursor.execute('''
-        SELECT task_name, task_category, completed FROM tasks WHERE date = ? AND id = ?
+        SELECT task_category, completed, completed_at FROM tasks WHERE date = ? AND id = ?
     ''', (date_str, task_id))
     row = cursor.fetchone()
     
     if not row:
-        conn.close()
-        return jsonify({"success": False, "error": "Task not found"}), 404
+        return None
     
     task_category = row['task_category']
     old_completed = bool(row['completed'])
+    day_type = DAY_TYPES.get(datetime.strptime(date_str, '%Y-%m-%d').weekday(), "学习日")
+    
+    if old_completed == new_completed:
+        # 幂等：重复点击（或另一台设备已经点过）不产生任何计数变化
+        completed_at = row['completed_at']
+        return {
+            "completedAt": completed_at[11:16] if completed_at else None,
+            "stats": adjust_daily_stats(conn, date_str, day_type, task_category, 0),
+            "newAchievements": []
+        }
     
     # 更新任务状态
     completed_at = now().strftime('%Y-%m-%d %H:%M:%S') if new_completed else None
     cursor.execute('''
         UPDATE tasks SET completed = ?, completed_at = ? WHERE date = ? AND id = ?
     ''', (1 if new_completed else 0, completed_at, date_str, task_id))
-    conn.commit()
-    conn.close()
-    
-    weekday = now().weekday()
-    day_type = DAY_TYPES.get(weekday, "学习日")
     
-    # 更新每日统计
-    stats = update_daily_stats(date_str, day_type)
+    delta = 1 if new_completed else -1
+    # 每日统计、累计统计、连续打卡、成就全部在同一事务内更新
+    stats = adjust_daily_stats(conn, date_str, day_type, task_category, delta)
+    adjust_lifetime_stats(conn, task_category, delta)
+    main_delta = delta if task_category == 'main' else 0
+    opt_delta = delta if task_category == 'optional' else 0
+    changed_metrics = adjust_lifetime_days(conn, day_type, day_flags(stats, main_delta, opt_delta), day_flags(stats))
+    changed_metrics.add('total_tasks_completed')
+    changed_metrics.add('main_tasks_completed' if task_category == 'main' else 'optional_tasks_completed')
+    if update_streak(conn, date_str):
+        changed_metrics.add('max_streak')
+    
+    # 取消打卡只会让指标减少，不可能解锁新成就
+    new_achievements = check_achievements(conn, changed_metrics) if new_completed else []
+    
+    record_change(conn, 'task', {
+        "date": date_str,
+        "taskId": task_id,
+        "completed": new_completed,
+        "stats": stats
+    })
     
-    # 根据状态变化调整累计统计
-    if old_completed != new_completed:
-        if new_completed:
-            adjust_lifetime_stats(task_category, 1)
-        else:
-            adjust_lifetime_stats(task_category, -1)
+    return {
+        "completedAt": completed_at[11:16] if completed_at else None,
+        "stats": stats,
+        "newAchievements": new_achievements
+    }
+
+
+@app.route('/api/task/<int:task_id>', methods=['POST'])
+def toggle_task(task_id):
+    """切换任务完成状态"""
+    date_str = now().strftime('%Y-%m-%d')
+    data = request.get_json() or {}
+    new_completed = bool(data.get('completed', True))
     
-    # 更新连续打卡
-    update_streak(date_str)
+    # 整个切换流程在一个写事务内完成，与同时到达的其它写操作一起提交
+    result = run_write(apply_task_toggle, date_str, task_id, new_completed)
     
-    # 检查成就
-    new_achievements = []
-    if new_completed and not old_completed:
-        new_achievements = check_achievements()
+    if result is None:
+        return jsonify({"success": False, "error": "Task not found"}), 404
     
     return jsonify({
         "success": True,
         "taskId": task_id,
         "completed": new_completed,
-        "completedAt": now().strftime('%H:%M') if new_completed else None,
-        "stats": stats,
-        "newAchievements": new_achievements
+        **result
     })
 
 
 @app.route('/api/week')
+@etag_cached(readonly=True)
 def get_week():
     """获取本周7天统计"""
-    week_data = get_week_stats()
-    streak = get_streak_info()
+    conn = get_db_connection(readonly=True)
+    week_data = get_week_stats(conn)
+    streak = get_streak_info(conn)
     
     return jsonify({
         "weekData": week_data,
@@ -794,10 +3123,74 @@ def get_week():
     })
 
 
+def iter_export_batches(conn, table):
+    """以 fetchmany 分批读取一张表，返回 (列名, 批次生成器)"""
+    cursor = conn.execute(EXPORT_TABLES[table])
+    columns = [column[0] for column in cursor.description]
+    
+    def batches():
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                return
+            yield rows
+    
+    return columns, batches()
+
+
+def generate_export(pool, fmt, table=None):
+    """流式导出生成器：逐批编码输出，内存占用与数据库大小无关"""
+    # 连接在生成器内部获取：响应体开始输出时请求上下文已经结束，连接池需由调用方传入
+    conn = pool.acquire()
+    try:
+        # 整个导出处于同一读事务中，得到一致的时间点快照
+        conn.execute('BEGIN')
+        if fmt == 'ndjson':
+            yield json.dumps({"type": "meta", "exportTime": now().strftime('%Y-%m-%d %H:%M:%S')},
+                             ensure_ascii=False) + '\n'
+            for name in EXPORT_TABLES:
+                columns, batches = iter_export_batches(conn, name)
+                for rows in batches:
+                    yield ''.join(json.dumps({"type": name, "row": dict(zip(columns, row))},
+                                             ensure_ascii=False) + '\n' for row in rows)
+        else:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            columns, batches = iter_export_batches(conn, table)
+            # BOM 让 Excel 正确识别 UTF-8 中文
+            writer.writerow(columns)
+            yield '\ufeff' + buffer.getvalue()
+            for rows in batches:
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(tuple(row) for row in rows)
+                yield buffer.getvalue()
+    finally:
+        pool.release(conn)
+
+
 @app.route('/api/export')
 def export_data():
-    """导出所有数据为JSON"""
-    conn = get_db_connection()
+    """导出所有数据：默认 JSON；?format=ndjson 或 ?format=csv&table=<表名> 为流式导出"""
+    fmt = request.args.get('format', 'json')
+    
+    if fmt in ('ndjson', 'csv'):
+        table = request.args.get('table', 'tasks')
+        if fmt == 'csv' and table not in EXPORT_TABLES:
+            return jsonify({"error": "Invalid table", "tables": list(EXPORT_TABLES)}), 400
+        
+        stamp = now().strftime('%Y%m%d')
+        filename = f"operations-{stamp}.ndjson" if fmt == 'ndjson' else f"operations-{table}-{stamp}.csv"
+        mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+        return Response(generate_export(current_tenant().read_pool, fmt, table), mimetype=mimetype, headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Accel-Buffering': 'no'
+        })
+    
+    if fmt != 'json':
+        return jsonify({"error": "Invalid format", "formats": ["json", "ndjson", "csv"]}), 400
+    
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM tasks ORDER BY date')
@@ -807,10 +3200,12 @@ def export_data():
     stats = [dict(row) for row in cursor.fetchall()]
     
     cursor.execute('SELECT * FROM streak_record LIMIT 1')
-    streak = dict(cursor.fetchone()) if cursor.fetchone() else {}
+    row = cursor.fetchone()
+    streak = dict(row) if row else {}
     
     cursor.execute('SELECT * FROM lifetime_stats LIMIT 1')
-    lifetime = dict(cursor.fetchone()) if cursor.fetchone() else {}
+    row = cursor.fetchone()
+    lifetime = dict(row) if row else {}
     
     cursor.execute('SELECT * FROM achievements')
     achievements = [dict(row) for row in cursor.fetchall()]
@@ -818,8 +3213,6 @@ def export_data():
     cursor.execute('SELECT * FROM task_templates')
     templates = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
-    
     return jsonify({
         "exportTime": now().strftime('%Y-%m-%d %H:%M:%S'),
         "tasks": tasks,
@@ -832,6 +3225,7 @@ def export_data():
 
 
 @app.route('/api/history/<date_str>')
+@etag_cached(readonly=True)
 def get_history(date_str):
     """获取指定日期的任务完成情况"""
     try:
@@ -839,17 +3233,15 @@ def get_history(date_str):
     except ValueError:
         return jsonify({"error": "Invalid date format"}), 400
     
-    tasks, day_type = generate_daily_tasks(date_str)
-    completed_tasks = get_completed_tasks_by_date(date_str)
+    # 只读：不为任意日期物化任务实例
+    conn = get_db_connection(readonly=True)
+    tasks, day_type = project_daily_tasks(conn, date_str)
+    completed_tasks = get_completed_tasks_by_date(date_str, conn)
     
-    conn = get_db_connection()
     cursor = conn.cursor()
-    
     cursor.execute('SELECT * FROM daily_stats WHERE date = ?', (date_str,))
     stats_row = cursor.fetchone()
     
-    conn.close()
-    
     main_tasks = [t for t in tasks if t['category'] == 'main']
     
     stats = {
@@ -870,25 +3262,46 @@ def get_history(date_str):
 
 
 @app.route('/api/history/range/<start_date>/<end_date>')
+@etag_cached(readonly=True)
 def get_history_range(start_date, end_date):
-    """获取日期范围内的历史记录"""
+    """获取日期范围内的历史记录（按日期倒序，?limit= 每页条数，?before= 上一页返回的 nextCursor）"""
     try:
         start = datetime.strptime(start_date, '%Y-%m-%d')
         end = datetime.strptime(end_date, '%Y-%m-%d')
+        before = request.args.get('before')
+        if before:
+            datetime.strptime(before, '%Y-%m-%d')
     except ValueError:
         return jsonify({"error": "Invalid date format"}), 400
     
-    conn = get_db_connection()
+    if end < start:
+        return jsonify({"error": "结束日期不能早于开始日期"}), 400
+    if (end - start).days >= HISTORY_MAX_SPAN_DAYS:
+        return jsonify({"error": f"日期范围不能超过 {HISTORY_MAX_SPAN_DAYS} 天"}), 400
+    
+    try:
+        limit = int(request.args.get('limit', HISTORY_MAX_SPAN_DAYS))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    limit = max(1, min(limit, HISTORY_MAX_SPAN_DAYS))
+    
+    # 键集分页：从上一页最后一条的日期继续往前取，多取一条判断是否还有下一页
+    upper = min(end_date, before) if before else end_date
+    upper_op = '<' if before and before <= end_date else '<='
+    
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     
-    cursor.execute('''
+    cursor.execute(f'''
         SELECT * FROM daily_stats 
-        WHERE date >= ? AND date <= ?
+        WHERE date >= ? AND date {upper_op} ?
         ORDER BY date DESC
-    ''', (start_date, end_date))
+        LIMIT ?
+    ''', (start_date, upper, limit + 1))
+    rows = cursor.fetchall()
     
     history = []
-    for row in cursor.fetchall():
+    for row in rows[:limit]:
         history.append({
             "date": row['date'],
             "dayType": row['day_type'],
@@ -899,16 +3312,53 @@ def get_history_range(start_date, end_date):
             "isValidCheckin": bool(row['is_valid_checkin'])
         })
     
-    conn.close()
-    
     return jsonify({
         "startDate": start_date,
         "endDate": end_date,
-        "history": history
+        "history": history,
+        "nextCursor": history[-1]['date'] if len(rows) > limit else None
+    })
+
+
+@app.route('/api/history/heatmap')
+@etag_cached(readonly=True)
+def get_history_heatmap():
+    """整年热力图：按列返回（当年第几天、主线完成率、是否有效打卡三个平行数组）"""
+    try:
+        year = int(request.args.get('year', now().year))
+        start = datetime(year, 1, 1)
+        end = datetime(year + 1, 1, 1)
+    except ValueError:
+        return jsonify({"error": "Invalid year"}), 400
+    start_date = start.strftime('%Y-%m-%d')
+    end_date = end.strftime('%Y-%m-%d')
+    
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT CAST(julianday(date) - julianday(?) AS INTEGER),
+               CAST(ROUND(main_completed_rate) AS INTEGER),
+               is_valid_checkin
+        FROM daily_stats
+        WHERE date >= ? AND date < ?
+        ORDER BY date
+    ''', (start_date, start_date, end_date))
+    rows = cursor.fetchall()
+    
+    days, rates, checkins = (list(column) for column in zip(*rows)) if rows else ([], [], [])
+    return jsonify({
+        "year": year,
+        "startDate": start_date,
+        "length": (end - start).days,
+        "days": days,
+        "rates": rates,
+        "checkins": checkins,
+        "checkinDays": sum(checkins)
     })
 
 
 @app.route('/api/lifetime')
+@etag_cached
 def get_lifetime():
     """获取累计学习统计"""
     lifetime = get_lifetime_stats()
@@ -921,12 +3371,82 @@ def get_lifetime():
 
 
 @app.route('/api/achievements')
+@etag_cached
 def get_achievements():
     """获取所有成就"""
     achievements = get_all_achievements()
     return jsonify({"achievements": achievements})
 
 
+def open_change_stream(subscriber=None, max_clients=SSE_MAX_CLIENTS):
+    """订阅当前用户的变更并取出断线期间错过的事件，返回 (总线, 订阅者, 补发事件)；
+    推送客户端已达上限时返回 None"""
+    if tenants.subscriber_count() >= max_clients:
+        return None
+    
+    change_bus = current_tenant().change_bus
+    subscriber = change_bus.subscribe(subscriber)
+    
+    # 断线重连时补发错过的变更（先订阅再查库，避免两者之间的变更丢失）
+    backlog = []
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if last_event_id.isdigit():
+        conn = get_db_connection(readonly=True)
+        backlog = fetch_changes_since(conn, int(last_event_id))
+    return change_bus, subscriber, backlog
+
+
+@app.route('/api/stream')
+def stream_changes():
+    """Server-Sent Events：任务打卡、模板修改等变更提交后实时推送"""
+    # ASGI 模式下 asgi.py 传入异步订阅者，推送在事件循环里进行，不占用线程
+    async_subscriber = request.environ.get('dashboard.async_subscriber')
+    max_clients = SSE_MAX_CLIENTS if async_subscriber is None else ASGI_SSE_MAX_CLIENTS
+    stream = open_change_stream(async_subscriber, max_clients)
+    if stream is None:
+        # 前端收到非 200 会退回定时轮询
+        return jsonify({"error": "Too many stream clients"}), 503
+    change_bus, subscriber, backlog = stream
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    }
+    if async_subscriber is not None:
+        request.environ['dashboard.async_stream'] = (change_bus, backlog)
+        return Response(mimetype='text/event-stream', headers=headers)
+    
+    def generate():
+        last_seq = backlog[-1]['seq'] if backlog else 0
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        try:
+            yield 'retry: 3000\n\n'
+            for event in backlog:
+                yield format_sse(event)
+            # 定期断开让浏览器带着 Last-Event-ID 重连，释放长期占用的线程
+            while time.monotonic() < deadline:
+                try:
+                    event = subscriber.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if event['kind'] != 'resync' and event['seq'] <= last_seq:
+                    continue
+                last_seq = max(last_seq, event['seq'])
+                yield format_sse(event)
+        finally:
+            change_bus.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 抓取接口，汇总所有 worker 的计数"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 # ==================== 管理后台 API ====================
 
 @app.route('/api/admin/login', methods=['POST'])
@@ -968,7 +3488,7 @@ def get_all_task_templates():
     cursor.execute('SELECT * FROM task_templates ORDER BY id')
     templates = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
+    release_db_connection(conn)
     return jsonify({"templates": templates})
 
 
@@ -985,17 +3505,21 @@ def create_task_template():
     if not task_name:
         return jsonify({"success": False, "error": "任务名称不能为空"}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
+    def insert_template(conn):
+        cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO task_templates (task_name, task_category, weekdays, is_system)
             VALUES (?, ?, ?, 0)
         ''', (task_name, task_category, weekdays))
-        conn.commit()
         template_id = cursor.lastrowid
-        conn.close()
+        sync_template_weekdays(cursor, template_id, weekdays)
+        bump_meta_version(conn, 'template_version')
+        record_change(conn, 'templates', {"action": "create", "templateId": template_id})
+        return template_id
+    
+    try:
+        template_id = run_write(insert_template)
+        current_tenant().template_cache.invalidate()
         
         return jsonify({
             "success": True,
@@ -1009,7 +3533,6 @@ def create_task_template():
             }
         })
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({"success": False, "error": "任务名称已存在"}), 400
 
 
@@ -1026,33 +3549,34 @@ def update_task_template(template_id):
     if not task_name:
         return jsonify({"success": False, "error": "任务名称不能为空"}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE task_templates 
-        SET task_name = ?, task_category = ?, weekdays = ?
-        WHERE id = ?
-    ''', (task_name, task_category, weekdays, template_id))
+    def update_template(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE task_templates 
+            SET task_name = ?, task_category = ?, weekdays = ?
+            WHERE id = ?
+        ''', (task_name, task_category, weekdays, template_id))
+        
+        if cursor.rowcount == 0:
+            return False
+        
+        sync_template_weekdays(cursor, template_id, weekdays)
+        
+        # 更新今日及未来的任务实例名称（与模板修改同一事务提交）
+        today = now().strftime('%Y-%m-%d')
+        cursor.execute('''
+            UPDATE tasks 
+            SET task_name = ?, task_category = ?, task_type = ?
+            WHERE template_id = ? AND date >= ? AND completed = 0
+        ''', (task_name, task_category, task_category, template_id, today))
+        
+        bump_meta_version(conn, 'template_version')
+        record_change(conn, 'templates', {"action": "update", "templateId": template_id})
+        return True
     
-    if cursor.rowcount == 0:
-        conn.close()
+    if not run_write(update_template):
         return jsonify({"success": False, "error": "任务不存在"}), 404
-    
-    conn.commit()
-    conn.close()
-    
-    # 更新今日及未来的任务实例名称
-    today = now().strftime('%Y-%m-%d')
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE tasks 
-        SET task_name = ?, task_category = ?, task_type = ?
-        WHERE template_id = ? AND date >= ? AND completed = 0
-    ''', (task_name, task_category, task_category, template_id, today))
-    conn.commit()
-    conn.close()
+    current_tenant().template_cache.invalidate()
     
     return jsonify({
         "success": True,
@@ -1070,9 +3594,7 @@ def update_task_template(template_id):
 @admin_required
 def delete_task_template(template_id):
     """删除任务模板"""
-    conn = None
-    try:
-        conn = get_db_connection()
+    def delete_template(conn):
         cursor = conn.cursor()
         
         # 获取任务信息
@@ -1080,36 +3602,134 @@ def delete_task_template(template_id):
         template = cursor.fetchone()
         
         if not template:
-            conn.close()
-            return jsonify({"success": False, "error": "任务不存在"}), 404
+            return False
         
         # 删除今日及未来的任务实例（先删实例，再删模板）
         today = now().strftime('%Y-%m-%d')
         cursor.execute('DELETE FROM tasks WHERE template_id = ? AND date >= ?', (template_id, today))
         
-        # 删除任务模板
+        # 删除任务模板及其排期索引
+        cursor.execute('DELETE FROM template_weekdays WHERE template_id = ?', (template_id,))
         cursor.execute('DELETE FROM task_templates WHERE id = ?', (template_id,))
-        
-        conn.commit()
-        conn.close()
+        bump_meta_version(conn, 'template_version')
+        record_change(conn, 'templates', {"action": "delete", "templateId": template_id})
+        return True
+    
+    try:
+        if not run_write(delete_template):
+            return jsonify({"success": False, "error": "任务不存在"}), 404
+        current_tenant().template_cache.invalidate()
         
         return jsonify({"success": True, "message": "任务删除成功"})
-    except sqlite3.Error as e:
-        if conn:
-            conn.rollback()
-            conn.close()
-        return jsonify({"success": False, "error": f"删除失败: {str(e)}"}), 500
+    except WriteTimeout:
+        raise
     except Exception as e:
-        if conn:
-            conn.close()
         return jsonify({"success": False, "error": f"删除失败: {str(e)}"}), 500
 
+@app.route('/api/admin/reconcile-stats', methods=['POST'])
+@admin_required
+def reconcile_stats():
+    """从任务记录重算每日统计，报告并修复计数漂移"""
+    data = request.get_json(silent=True) or {}
+    fix = not data.get('dryRun', False)
+    
+    # 修复的每一天都由 save_daily_stats 记录变更
+    return jsonify({"success": True, **run_write(reconcile_daily_stats, fix)})
+
+
+@app.route('/api/admin/recompute', methods=['POST'])
+@admin_required
+def recompute_stats():
+    """从任务记录全量重建每日统计、连续打卡、累计统计和成就"""
+    data = request.get_json(silent=True) or {}
+    fix = not data.get('dryRun', False)
+    
+    def recompute(conn):
+        result = recompute_aggregates(conn, fix=fix)
+        if fix and result['changed']:
+            record_change(conn, 'stats', {"dates": result['drifted']})
+        return result
+    
+    return jsonify({"success": True, **run_write(recompute)})
+
+
+@app.route('/api/admin/db-pool')
+@admin_required
+def get_db_pool_stats():
+    """查看当前 worker 中当前用户的连接池命中情况与写线程批次统计"""
+    tenant = current_tenant()
+    return jsonify({
+        "tenant": tenant.name,
+        "openTenants": tenants.open_count(),
+        "primary": tenant.pool.stats(),
+        "readOnly": tenant.read_pool.stats(),
+        "writer": tenant.writer.stats()
+    })
+
+
+@app.route('/api/admin/perf', methods=['GET'])
+@admin_required
+def get_perf_stats():
+    """查看当前 worker 最近一段时间各接口与函数的耗时分布（需开启 PERF_TRACE）"""
+    return jsonify(perf_recorder.snapshot())
+
+
+@app.route('/api/admin/perf', methods=['DELETE'])
+@admin_required
+def reset_perf_stats():
+    """清空当前 worker 的性能统计"""
+    perf_recorder.reset()
+    return jsonify({'success': True})
+
+
+@app.route('/api/admin/tenants', methods=['GET'])
+@admin_required
+def get_tenants():
+    """列出所有用户"""
+    return jsonify({
+        "current": current_tenant().name,
+        "multiTenant": bool(TENANTS_DIR),
+        "tenants": tenants.names()
+    })
+
+
+@app.route('/api/admin/tenants', methods=['POST'])
+@admin_required
+def create_tenant():
+    """新建用户（独立的数据库文件）"""
+    if not TENANTS_DIR:
+        return jsonify({'success': False, 'error': '未启用多用户（TENANTS_DIR）'}), 400
+    name = (request.get_json(silent=True) or {}).get('name', '')
+    if not TENANT_NAME_PATTERN.match(name) or name == DEFAULT_TENANT:
+        return jsonify({'success': False, 'error': '用户名只能包含小写字母、数字、- 和 _'}), 400
+    try:
+        tenant = tenants.create(name)
+    except FileExistsError:
+        return jsonify({'success': False, 'error': '用户已存在'}), 409
+    return jsonify({'success': True, 'tenant': tenant.name, 'url': f'/u/{tenant.name}/'})
+
 # 导出数据库
 @app.route('/api/admin/export-db', methods=['GET'])
 @admin_required
 def export_db():
-    """导出数据库文件"""
-    return send_file('./data/operations.db', as_attachment=True)
+    """导出数据库文件：在线备份出一致的快照，默认 gzip 流式压缩下载（?compress=0 下载原始 .db）"""
+    fd, snapshot_path = tempfile.mkstemp(dir=os.path.dirname(current_tenant().db_path), suffix='.export')
+    os.close(fd)
+    try:
+        backup_database(snapshot_path)
+    except sqlite3.Error as e:
+        os.remove(snapshot_path)
+        return jsonify({'success': False, 'error': f'备份失败: {str(e)}'}), 500
+    
+    stamp = now().strftime('%Y%m%d%H%M%S')
+    if request.args.get('compress') == '0':
+        response = send_file(snapshot_path, as_attachment=True, download_name=f'operations_{stamp}.db')
+        response.call_on_close(lambda: os.remove(snapshot_path))
+        return response
+    
+    return Response(iter_gzip_file(snapshot_path, remove=True), mimetype='application/gzip', headers={
+        'Content-Disposition': f'attachment; filename="operations_{stamp}.db.gz"'
+    })
 
 # 导入数据库
 @app.route('/api/admin/import-db', methods=['POST'])
@@ -1123,28 +3743,107 @@ def import_db():
     if file.filename == '':
         return jsonify({'success': False, 'error': '文件名为空'}), 400
     
-    # 确保是 .db 文件
-    if not file.filename.endswith('.db'):
-        return jsonify({'success': False, 'error': '必须是 .db 文件'}), 400
+    # 确保是 .db 文件（或导出的 .db.gz 备份）
+    if not file.filename.endswith(('.db', '.db.gz')):
+        return jsonify({'success': False, 'error': '必须是 .db 或 .db.gz 文件'}), 400
     
-    # 备份原数据库
-    backup_path = './data/operations.db.backup.' + now().strftime('%Y%m%d%H%M%S')
-    if os.path.exists('./data/operations.db'):
-        shutil.copy2('./data/operations.db', backup_path)
+    # 先落到临时文件并校验，校验通过前不触碰主库
+    data_dir = os.path.dirname(current_tenant().db_path)
+    try:
+        temp_path = save_stream_to_temp(file.stream, data_dir)
+    except (OSError, zlib.error):
+        return jsonify({'success': False, 'error': '文件解压失败'}), 400
     
-    # 保存新数据库
-    file.save('./data/operations.db')
+    try:
+        error, snapshot = restore_from_temp(temp_path)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+    except sqlite3.Error as e:
+        return jsonify({'success': False, 'error': f'恢复失败: {str(e)}'}), 500
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
     
     return jsonify({
         'success': True, 
         'message': '数据库已恢复，原数据库已备份',
-        'backup': backup_path
+        'backup': snapshot['name']
     })
 
-# 初始化数据库
-init_database()
+@app.route('/api/admin/backups', methods=['GET'])
+@admin_required
+def get_backups():
+    """列出服务器上的快照及保留策略"""
+    return jsonify({
+        "backups": [snapshot_info(s) for s in list_snapshots()],
+        "intervalHours": BACKUP_INTERVAL_HOURS,
+        "retention": {
+            "daily": BACKUP_KEEP_DAILY,
+            "weekly": BACKUP_KEEP_WEEKLY,
+            "monthly": BACKUP_KEEP_MONTHLY,
+        },
+    })
 
-if __name__ == '__main__':
+@app.route('/api/admin/backups', methods=['POST'])
+@admin_required
+def create_backup():
+    """立即创建一份快照，并按保留策略清理"""
+    try:
+        snapshot = take_snapshot('manual')
+        removed = prune_snapshots()
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({'success': False, 'error': f'快照失败: {str(e)}'}), 500
+    return jsonify({'success': True, 'backup': snapshot_info(snapshot), 'removed': removed})
+
+@app.route('/api/admin/backups/<name>', methods=['GET'])
+@admin_required
+def download_backup(name):
+    """下载指定快照"""
+    snapshot = find_snapshot(name)
+    if not snapshot:
+        return jsonify({'error': '快照不存在'}), 404
+    return send_file(snapshot['path'], as_attachment=True, download_name=snapshot['name'])
+
+@app.route('/api/admin/backups/<name>/restore', methods=['POST'])
+@admin_required
+def restore_backup(name):
+    """从服务器上的快照恢复主库，恢复前先快照当前数据"""
+    snapshot = find_snapshot(name)
+    if not snapshot:
+        return jsonify({'success': False, 'error': '快照不存在'}), 404
+    
+    try:
+        with open(snapshot['path'], 'rb') as f:
+            temp_path = save_stream_to_temp(f, os.path.dirname(current_tenant().db_path))
+    except (OSError, zlib.error):
+        return jsonify({'success': False, 'error': '快照解压失败'}), 400
+    
+    try:
+        error, pre_restore = restore_from_temp(temp_path)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+    except sqlite3.Error as e:
+        return jsonify({'success': False, 'error': f'恢复失败: {str(e)}'}), 500
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    return jsonify({
+        'success': True,
+        'message': f'已从 {name} 恢复，原数据库已备份',
+        'backup': pre_restore['name']
+    })
+
+# 作为模块导入（gunicorn、测试）时迁移数据库表结构，已是最新版本时只读一次 user_version；
+# 命令行方式运行时由 main() 决定是否迁移，migrate --status 需要看到迁移前的版本
+if __name__ != '__main__':
+    migrate_database()
+
+
+# ==================== 命令行 ====================
+
+def run_server():
+    """启动开发服务器"""
     print("=" * 50)
     print("Operation Dashboard - 作战仪表盘 v3.1")
     print("=" * 50)
@@ -1157,3 +3856,127 @@ if __name__ == '__main__':
     
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
+
+
+def run_reconcile(dry_run=False):
+    """命令行：重算 daily_stats 并报告漂移"""
+    conn = get_db_connection()
+    try:
+        with db_transaction(conn, immediate=True):
+            result = reconcile_daily_stats(conn, fix=not dry_run)
+    finally:
+        release_db_connection(conn)
+    
+    print(f"检查 {result['checked']} 天，漂移 {len(result['drifted'])} 天")
+    for date_str in result['drifted']:
+        print(f"  {date_str}{'' if dry_run else ' (已修复)'}")
+    return 1 if dry_run and result['drifted'] else 0
+
+
+def run_migrate(name=DEFAULT_TENANT, status_only=False):
+    """命令行：显示某个用户的表结构版本并执行未完成的迁移"""
+    db_path = tenants.path_for(name)
+    if db_path is None or (name != DEFAULT_TENANT and not os.path.exists(db_path)):
+        print(f"用户不存在: {name}")
+        return 1
+    if TENANTS_DIR:
+        print(f"用户 {name}")
+    version = get_schema_version(db_path)
+    print(f"当前表结构版本 v{version}，最新 v{SCHEMA_VERSION}")
+    if version > SCHEMA_VERSION:
+        print("数据库版本高于当前代码，请升级代码")
+        return 1
+    pending = MIGRATIONS[version:]
+    for number, migration in enumerate(pending, version + 1):
+        print(f"  待执行 v{number}: {migration.__doc__}")
+    if status_only or not pending:
+        return 0
+    
+    before, after = migrate_database(db_path)
+    print(f"已从 v{before} 迁移到 v{after}")
+    return 0
+
+
+def run_recompute(dry_run=False):
+    """命令行：全量重建所有聚合数据并报告差异"""
+    conn = get_db_connection()
+    try:
+        with db_transaction(conn, immediate=True):
+            result = recompute_aggregates(conn, fix=not dry_run)
+            if not dry_run and result['changed']:
+                record_change(conn, 'stats', {"dates": result['drifted']})
+    finally:
+        release_db_connection(conn)
+    
+    suffix = '' if dry_run else ' (已修复)'
+    print(f"检查 {result['checked']} 天，用时 {result['elapsedMs']} ms")
+    print(f"每日统计漂移 {len(result['drifted'])} 天{suffix if result['drifted'] else ''}")
+    for date_str in result['drifted'][:20]:
+        print(f"  {date_str}")
+    if len(result['drifted']) > 20:
+        print(f"  ... 另有 {len(result['drifted']) - 20} 天")
+    if result['streak']:
+        print(f"连续打卡 {result['streak']['before']} -> {result['streak']['after']}{suffix}")
+    for column, (old, new) in result['lifetime'].items():
+        print(f"累计统计 {column}: {old} -> {new}{suffix}")
+    for ach_id in result['newAchievements']:
+        print(f"{'可解锁' if dry_run else '已解锁'}成就 {ACHIEVEMENTS[ach_id]['name']}")
+    return 1 if dry_run and result['changed'] else 0
+
+
+def run_backup(list_only=False, prune=True):
+    """命令行：立即快照并清理，供 cron 调用；--list 只列出现有快照"""
+    if not list_only:
+        snapshot = take_snapshot()
+        print(f"已创建快照 {snapshot['name']} ({snapshot['size']} 字节)")
+        if prune:
+            for name in prune_snapshots():
+                print(f"  已清理 {name}")
+    
+    for snapshot in list_snapshots():
+        info = snapshot_info(snapshot)
+        print(f"{info['createdAt']}  {info['kind']:<12} {info['size']:>10}  {info['name']}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Operation Dashboard - 作战仪表盘')
+    parser.add_argument('--user', default=DEFAULT_TENANT, help='要操作的用户（多用户模式，见 TENANTS_DIR）')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help='启动 Web 服务（默认）')
+    reconcile_parser = subparsers.add_parser('reconcile', help='从 tasks 重算 daily_stats，修复增量计数漂移')
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='只报告漂移，不修改数据库')
+    recompute_parser = subparsers.add_parser('recompute', help='从 tasks 全量重建每日统计、连续打卡、累计统计和成就')
+    recompute_parser.add_argument('--dry-run', action='store_true', help='只报告差异，不修改数据库')
+    migrate_parser = subparsers.add_parser('migrate', help='执行未完成的表结构迁移')
+    migrate_parser.add_argument('--status', action='store_true', help='只显示当前版本和待执行的迁移')
+    migrate_parser.add_argument('--all', action='store_true', help='依次处理所有用户的数据库')
+    backup_parser = subparsers.add_parser('backup', help='立即创建快照并按保留策略清理（可由 cron 定时调用）')
+    backup_parser.add_argument('--list', action='store_true', help='只列出现有快照')
+    backup_parser.add_argument('--no-prune', action='store_true', help='创建快照后不清理旧快照')
+    args = parser.parse_args(argv)
+    
+    if args.command == 'migrate':
+        names = tenants.names() if args.all else [args.user]
+        return max([run_migrate(name, args.status) for name in names])
+    migrate_database()
+    if args.command in (None, 'serve'):
+        run_server()
+        return 0
+    
+    try:
+        with use_tenant(args.user):
+            if args.command == 'reconcile':
+                return run_reconcile(args.dry_run)
+            if args.command == 'recompute':
+                return run_recompute(args.dry_run)
+            if args.command == 'backup':
+                return run_backup(args.list, not args.no_prune)
+    except UnknownTenant:
+        print(f"用户不存在: {args.user}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())